@@ -1,7 +1,21 @@
-import os, time, json, re, sqlite3, smtplib
+import os, time, json, re, sqlite3, smtplib, argparse, queue, threading, asyncio, hashlib
+import math, zlib, random, base64, itertools, hmac, bisect
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from datetime import datetime
 from pathlib import Path
 from email.message import EmailMessage
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import aiohttp
+except ImportError:  # only needed for ENGINE=async
+    aiohttp = None
 
 WORKDIR = Path("/work")
 WORKDIR.mkdir(parents=True, exist_ok=True)
@@ -14,7 +28,9 @@ def env(k, d=None):
     return v
 
 def log(*a):
-    print(time.strftime("%Y-%m-%d %H:%M:%S"), "-", *a, flush=True)
+    # single write so lines from pipeline threads do not interleave
+    line = " ".join(str(x) for x in (time.strftime("%Y-%m-%d %H:%M:%S"), "-", *a))
+    print(line + "\n", end="", flush=True)
 
 # ---------------------------
 # Config
@@ -23,7 +39,14 @@ PAPERLESS_BASE_URL = env("PAPERLESS_BASE_URL", "http://webserver:8000").rstrip("
 PAPERLESS_TOKEN = env("PAPERLESS_TOKEN")
 PAPERLESS_DOWNLOAD_PATH_TEMPLATE = env("PAPERLESS_DOWNLOAD_PATH_TEMPLATE", "/api/documents/{id}/download/")
 
-OLLAMA_BASE_URL = env("OLLAMA_BASE_URL", "http://ollama:11434").rstrip("/")
+# comma-separated list of Ollama servers; requests are balanced across them
+OLLAMA_URLS = [u.strip().rstrip("/") for u in env("OLLAMA_BASE_URL", "http://ollama:11434").split(",") if u.strip()]
+OLLAMA_NODE_CONCURRENCY = int(env("OLLAMA_NODE_CONCURRENCY", "1"))  # requests in flight per server
+OLLAMA_BREAKER_FAILURES = int(env("OLLAMA_BREAKER_FAILURES", "3"))  # consecutive failures before a server is paused
+OLLAMA_BREAKER_SECONDS = int(env("OLLAMA_BREAKER_SECONDS", "30"))
+OLLAMA_HEALTH_SECONDS = int(env("OLLAMA_HEALTH_SECONDS", "15"))
+# optional "model=url|url;model=url": keep a model on these servers while any of them is healthy
+OLLAMA_PIN = env("OLLAMA_PIN", "")
 GATE_MODEL = env("OLLAMA_MODEL_GATE", "qwen2.5:3b")
 EXTRACT_MODEL = env("OLLAMA_MODEL_EXTRACT", "llama3.1:8b")
 GATE_INVOICE_MIN = float(env("GATE_INVOICE_MIN", "0.35"))
@@ -40,13 +63,137 @@ SMTP_PORT = int(env("SMTP_PORT","587"))
 SMTP_USER = env("SMTP_USER")
 SMTP_PASS = env("SMTP_PASS")
 MAIL_FROM = env("MAIL_FROM", SMTP_USER)
+SMTP_NOOP_SECONDS = int(env("SMTP_NOOP_SECONDS", "60"))  # NOOP-check a reused session idle this long
+SMTP_IDLE_SECONDS = int(env("SMTP_IDLE_SECONDS", "240"))  # close it between polls after this much idle time
+
+# Digest: one email per recipient per batch carrying all forwarded invoices as attachments
+SMTP_DIGEST = env("SMTP_DIGEST", "0") == "1"
+SMTP_DIGEST_MAX_DOCS = int(env("SMTP_DIGEST_MAX_DOCS", "20"))  # split bigger digests
+
+# Failed documents: retried with exponential backoff, parked as dead letters after DOC_MAX_ATTEMPTS
+DOC_MAX_ATTEMPTS = int(env("DOC_MAX_ATTEMPTS", "5"))
+DOC_RETRY_BACKOFF = float(env("DOC_RETRY_BACKOFF", "60"))  # 1min, 2min, 4min, ...
+DOC_RETRY_BACKOFF_MAX = float(env("DOC_RETRY_BACKOFF_MAX", "21600"))
+
+# Outbox: forwarding emails are stored in state.sqlite and retried with exponential backoff
+OUTBOX_POLL_SECONDS = int(env("OUTBOX_POLL_SECONDS", "10"))  # how often the sender looks for due retries
+OUTBOX_BACKOFF = float(env("OUTBOX_BACKOFF", "30"))  # 30s, 60s, 120s, ...
+OUTBOX_BACKOFF_MAX = float(env("OUTBOX_BACKOFF_MAX", "3600"))
 
 FARM_FORWARD_TO = env("FARM_FORWARD_TO")
 IT_FORWARD_TO = env("IT_FORWARD_TO")
 
 POLL_SECONDS = int(env("POLL_SECONDS","30"))
+# Adaptive sweep: again right away after a full page of new docs, doubling up to POLL_MAX_SECONDS while idle
+POLL_MAX_SECONDS = int(env("POLL_MAX_SECONDS", "300"))
+QUIET_HOURS = env("QUIET_HOURS", "")  # local time, e.g. "22:00-06:30"; sweeps slow down to QUIET_POLL_SECONDS
+QUIET_POLL_SECONDS = int(env("QUIET_POLL_SECONDS", "1800"))
+
+# Embedded HTTP listener (0 = off): GET /metrics for Prometheus, POST WEBHOOK_PATH with the document id,
+# e.g. from a Paperless workflow webhook action on "Document Added"; polling then becomes a sweep every RECONCILE_SECONDS
+HTTP_PORT = int(env("HTTP_PORT", "0"))
+HTTP_BIND = env("HTTP_BIND", "0.0.0.0")
+WEBHOOK_PATH = env("WEBHOOK_PATH", "/webhook")
+WEBHOOK_TOKEN = env("WEBHOOK_TOKEN", "")  # Authorization: Bearer <token> or ?token=<token>
+RECONCILE_SECONDS = int(env("RECONCILE_SECONDS", "600"))
 MAX_DOCS = int(env("MAX_DOCS_PER_LOOP","20"))
 
+# latest = re-list the newest MAX_DOCS each loop
+# cursor = only ask for documents newer than the stored high-water mark, paging through all of them
+POLL_MODE = env("POLL_MODE", "latest").strip().lower()
+POLL_CURSOR_FIELD = env("POLL_CURSOR_FIELD", "added").strip().lower()  # added | modified
+PAGE_SIZE = int(env("PAPERLESS_PAGE_SIZE", "100"))
+
+# serial   = one document at a time
+# pipeline = fetch / llm / forward stages with their own worker pools
+ENGINE = env("ENGINE", "serial").strip().lower()
+PIPELINE_FETCH_WORKERS = int(env("PIPELINE_FETCH_WORKERS", "2"))
+PIPELINE_LLM_WORKERS = int(env("PIPELINE_LLM_WORKERS", str(len(OLLAMA_URLS) * OLLAMA_NODE_CONCURRENCY)))  # concurrent Ollama requests
+PIPELINE_FORWARD_WORKERS = int(env("PIPELINE_FORWARD_WORKERS", "2"))
+PIPELINE_QUEUE_SIZE = int(env("PIPELINE_QUEUE_SIZE", "8"))
+
+# 0 = write each document's tags right away (one request per document)
+# N = collect final tag sets and write them in bulk every N documents / at the end of each poll
+TAG_BATCH_SIZE = int(env("TAG_BATCH_SIZE", "0"))
+
+# SQLite state (/work may be slow network storage). WAL does not work on NFS/SMB
+# shares; use DB_JOURNAL_MODE=DELETE there.
+DB_JOURNAL_MODE = env("DB_JOURNAL_MODE", "WAL").strip().upper()
+DB_SYNCHRONOUS = env("DB_SYNCHRONOUS", "NORMAL").strip().upper()
+# mark_done commits every N documents (and at the end of each poll); a crash can lose up to N-1
+DB_COMMIT_EVERY = max(1, int(env("DB_COMMIT_EVERY", "1")))
+
+# Parsed gate/extract results cached in state.sqlite, keyed by model + hash of the full prompt
+LLM_CACHE = env("LLM_CACHE", "1") == "1"
+LLM_CACHE_MAX_MB = float(env("LLM_CACHE_MAX_MB", "64"))
+
+# Near-duplicate detection: a re-scan reuses the earlier classification and is not forwarded twice
+DEDUP = env("DEDUP", "1") == "1"
+DEDUP_MAX_DISTANCE = int(env("DEDUP_MAX_DISTANCE", "3"))  # differing SimHash bits out of 64
+DEDUP_MIN_WORDS = int(env("DEDUP_MIN_WORDS", "30"))  # shorter texts are too unreliable to fingerprint
+
+# Stream /api/generate and stop as soon as the JSON object is complete
+OLLAMA_STREAM = env("OLLAMA_STREAM", "1") == "1"
+
+# schema = constrained decoding against the gate/extract JSON schema, json = any JSON, none = free text
+OLLAMA_FORMAT = env("OLLAMA_FORMAT", "schema").strip().lower()
+GATE_NUM_PREDICT = int(env("GATE_NUM_PREDICT", "160"))  # token budget, sized to the schema
+EXTRACT_NUM_PREDICT = int(env("EXTRACT_NUM_PREDICT", "400"))
+
+# per_doc = gate then extract for each document; batched = gate a whole batch, then extract it,
+# so each model is loaded once per batch; combined = skip GATE_MODEL, one extract prompt per document
+LLM_SCHEDULE = env("LLM_SCHEDULE", "per_doc").strip().lower()
+LLM_BATCH_SIZE = int(env("LLM_BATCH_SIZE", "50"))  # documents per gate/extract round in batched mode
+OLLAMA_KEEP_ALIVE = env("OLLAMA_KEEP_ALIVE", "30m")  # how long Ollama keeps a model loaded; empty = server default
+
+# Prompt text budgets: long documents are cut down to their most invoice-relevant lines
+TEXT_WINDOW = env("TEXT_WINDOW", "1") == "1"  # 0 = plain head truncation at the same budget
+GATE_TEXT_TOKENS = int(env("GATE_TEXT_TOKENS", "1000"))
+EXTRACT_TEXT_TOKENS = int(env("EXTRACT_TEXT_TOKENS", "2000"))
+
+# Rule-based pre-gate: clear non-invoices skip both models, clear invoices skip the gate model
+PREGATE = env("PREGATE", "1") == "1"
+PREGATE_MIN = float(env("PREGATE_MIN", "0.5"))  # score below -> not an invoice
+PREGATE_MAX = float(env("PREGATE_MAX", "6.0"))  # score at/above -> invoice, go straight to extract
+PREGATE_WEIGHTS = env("PREGATE_WEIGHTS", "")  # optional JSON file {"term": weight} added to / overriding the defaults
+
+# Local gate: hashed n-gram logistic regression trained with --train-gate from our own invoice tags
+GATE_MODE = env("GATE_MODE", "llm").strip().lower()  # llm | local
+GATE_LOCAL_PATH = Path(env("GATE_LOCAL_PATH", str(WORKDIR / "gate_model.json")))
+GATE_LOCAL_LOW = float(env("GATE_LOCAL_LOW", "0.1"))  # p(invoice) below -> not an invoice
+GATE_LOCAL_HIGH = float(env("GATE_LOCAL_HIGH", "0.9"))  # p(invoice) at/above -> invoice; in between -> GATE_MODEL
+GATE_TRAIN_MAX = int(env("GATE_TRAIN_MAX", "20000"))  # labeled documents pulled for training
+GATE_TRAIN_EPOCHS = int(env("GATE_TRAIN_EPOCHS", "5"))
+
+# Pooled keep-alive sessions for Paperless and Ollama (sync engines)
+HTTP_POOL_SIZE = int(env("HTTP_POOL_SIZE", "10"))  # connections kept per backend
+HTTP_RETRIES = int(env("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(env("HTTP_BACKOFF", "0.5"))  # 0.5s, 1s, 2s, ...
+
+# async = single event loop, aiohttp, many documents in flight
+ASYNC_CONCURRENCY = int(env("ASYNC_CONCURRENCY", "32"))  # documents in flight
+ASYNC_LLM_CONCURRENCY = int(env("ASYNC_LLM_CONCURRENCY", str(len(OLLAMA_URLS) * OLLAMA_NODE_CONCURRENCY)))  # concurrent Ollama requests
+ASYNC_HTTP_POOL = int(env("ASYNC_HTTP_POOL", "20"))  # pooled connections across Paperless + Ollama
+
+if POLL_MODE not in ("latest", "cursor"):
+    raise RuntimeError(f"Invalid POLL_MODE: {POLL_MODE}")
+if POLL_CURSOR_FIELD not in ("added", "modified"):
+    raise RuntimeError(f"Invalid POLL_CURSOR_FIELD: {POLL_CURSOR_FIELD}")
+if ENGINE not in ("serial", "pipeline", "async"):
+    raise RuntimeError(f"Invalid ENGINE: {ENGINE}")
+if ENGINE == "async" and aiohttp is None:
+    raise RuntimeError("ENGINE=async needs aiohttp (see requirements.txt)")
+if OLLAMA_FORMAT not in ("schema", "json", "none"):
+    raise RuntimeError(f"Invalid OLLAMA_FORMAT: {OLLAMA_FORMAT}")
+if GATE_MODE not in ("llm", "local"):
+    raise RuntimeError(f"Invalid GATE_MODE: {GATE_MODE}")
+if LLM_SCHEDULE not in ("per_doc", "batched", "combined"):
+    raise RuntimeError(f"Invalid LLM_SCHEDULE: {LLM_SCHEDULE}")
+if DB_JOURNAL_MODE not in ("WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY"):
+    raise RuntimeError(f"Invalid DB_JOURNAL_MODE: {DB_JOURNAL_MODE}")
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise RuntimeError(f"Invalid DB_SYNCHRONOUS: {DB_SYNCHRONOUS}")
+
 # Tags (created if missing)
 TAG_AI = env("TAG_AI", "ai-processed")
 TAG_INVOICE = env("TAG_INVOICE", "invoice")
@@ -58,48 +205,581 @@ TAG_REASON_KEYWORD = env("TAG_REASON_KEYWORD", "reason-keyword")
 TAG_TOPIC_FARM = env("TAG_TOPIC_FARM", "topic-farm")
 TAG_TOPIC_IT = env("TAG_TOPIC_IT", "topic-it")
 TAG_IT_DEDUCTIBLE = env("TAG_IT_DEDUCTIBLE", "deductible-it")
+TAG_DUPLICATE = env("TAG_DUPLICATE", "duplicate")
+TAG_FAILED = env("TAG_FAILED", "ai-failed")  # dead letters: gave up after DOC_MAX_ATTEMPTS
 
 IBAN_REGEX = re.compile(r"\b[A-Z]{2}\d{2}(?:\s?[A-Z0-9]{4}){2,7}\s?[A-Z0-9]{0,4}\b")
 
+# ---------------------------
+# HTTP
+# ---------------------------
+def paperless_headers():
+    return {"Authorization": f"Token {PAPERLESS_TOKEN}"}
+
+def make_session(retry_methods: frozenset, read_retries: int | None = None) -> requests.Session:
+    """
+    Session with a keep-alive connection pool and retries with exponential backoff
+    on connection errors/resets and 5xx. The final failed response is returned
+    (raise_on_status=False) so callers still see it via raise_for_status().
+    read_retries=0: a request that was sent but timed out / broke while reading is not re-sent.
+    """
+    retry = Retry(
+        total=HTTP_RETRIES,
+        read=read_retries,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=retry_methods,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    s = requests.Session()
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+# creating a tag (POST) is not idempotent, so Paperless only retries reads
+paperless_http = make_session(frozenset({"GET", "HEAD"}))
+paperless_http.headers.update(paperless_headers())
+# /api/generate has no side effects, but one that hit its 900s timeout must not run 3 more times:
+# read errors go to ollama_call(), which fails over to another endpoint instead
+ollama_http = make_session(frozenset({"GET", "POST"}), read_retries=0)
+
 # ---------------------------
 # DB
 # ---------------------------
+class DocIdSet:
+    """Bitmap of doc ids. Paperless ids are dense, so 80k ids take ~10 KB."""
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def add(self, doc_id: int) -> None:
+        i = doc_id >> 3
+        if i >= len(self.bits):
+            self.bits.extend(bytes(max(i + 1, len(self.bits) * 2) - len(self.bits)))
+        mask = 1 << (doc_id & 7)
+        if not self.bits[i] & mask:
+            self.bits[i] |= mask
+            self.count += 1
+
+    def __contains__(self, doc_id: int) -> bool:
+        i = doc_id >> 3
+        return 0 <= i < len(self.bits) and bool(self.bits[i] & (1 << (doc_id & 7)))
+
+    def __len__(self) -> int:
+        return self.count
+
+# processed_docs mirrored in memory (loaded by db_init, kept in sync by mark_done)
+_done = DocIdSet()
+
+# (simhash, doc_id) of doc_fingerprints, for the linear Hamming-distance scan
+_fingerprints: list[tuple[int, int]] = []
+
+# doc_failures mirrored in memory: doc_id -> (next_retry, dead)
+_failures: dict[int, tuple[int, bool]] = {}
+
+# doc_state mirrored in memory: doc_id -> checkpoint of a document that is not done yet
+_checkpoints: dict[int, dict] = {}
+
+_db: sqlite3.Connection | None = None
+_db_lock = threading.RLock()
+_db_uncommitted = 0
+
+def db() -> sqlite3.Connection:
+    """The one long-lived connection; callers hold _db_lock while using it."""
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(DB_PATH, check_same_thread=False)
+        _db.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+        _db.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    return _db
+
+def db_commit():
+    global _db_uncommitted
+    with _db_lock:
+        if _db_uncommitted:
+            with timed("forwarder_sqlite_seconds", op="commit"):
+                db().commit()
+            _db_uncommitted = 0
+
 def db_init():
-    with sqlite3.connect(DB_PATH) as c:
+    with _db_lock:
+        c = db()
         c.execute("""CREATE TABLE IF NOT EXISTS processed_docs(
             doc_id INTEGER PRIMARY KEY,
             processed_utc INTEGER NOT NULL
         )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS poll_cursor(
+            field TEXT PRIMARY KEY,
+            ts TEXT NOT NULL,
+            doc_id INTEGER NOT NULL
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS llm_cache(
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            result TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_utc INTEGER NOT NULL,
+            used_utc INTEGER NOT NULL
+        )""")
+        c.execute("CREATE INDEX IF NOT EXISTS llm_cache_used ON llm_cache(used_utc)")
+        c.execute("""CREATE TABLE IF NOT EXISTS doc_fingerprints(
+            doc_id INTEGER PRIMARY KEY,
+            simhash TEXT,
+            ibans TEXT NOT NULL,
+            invoice_number TEXT NOT NULL,
+            amount TEXT NOT NULL,
+            meta TEXT NOT NULL,
+            delivered INTEGER NOT NULL,
+            created_utc INTEGER NOT NULL,
+            text_keys TEXT
+        )""")
+        if "text_keys" not in {r[1] for r in c.execute("PRAGMA table_info(doc_fingerprints)")}:
+            c.execute("ALTER TABLE doc_fingerprints ADD COLUMN text_keys TEXT")  # NULL: never a near-duplicate
+        c.execute("CREATE INDEX IF NOT EXISTS doc_fingerprints_invoice ON doc_fingerprints(invoice_number)")
+        c.execute("""CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            doc_id INTEGER NOT NULL,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            tags TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt INTEGER,
+            last_error TEXT,
+            created_utc INTEGER NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0
+        )""")
+        if "sent" not in {r[1] for r in c.execute("PRAGMA table_info(outbox)")}:
+            c.execute("ALTER TABLE outbox ADD COLUMN sent INTEGER NOT NULL DEFAULT 0")
+        c.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox(next_attempt)")
+        c.execute("""CREATE TABLE IF NOT EXISTS doc_failures(
+            doc_id INTEGER PRIMARY KEY,
+            stage TEXT NOT NULL,
+            error TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_retry INTEGER NOT NULL,
+            dead INTEGER NOT NULL,
+            tagged INTEGER NOT NULL,
+            updated_utc INTEGER NOT NULL
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS doc_state(
+            doc_id INTEGER PRIMARY KEY,
+            text_sha TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            gate TEXT,
+            meta TEXT,
+            updated_utc INTEGER NOT NULL
+        )""")
+        # digest rows held by a run that died before its batch ended
+        c.execute("UPDATE outbox SET next_attempt=? WHERE next_attempt IS NULL", (int(time.time()),))
         c.commit()
+        for doc_id, h in c.execute("SELECT doc_id, simhash FROM doc_fingerprints WHERE simhash IS NOT NULL"):
+            _fingerprints.append((int(h, 16), int(doc_id)))
+        for (doc_id,) in c.execute("SELECT doc_id FROM processed_docs"):
+            _done.add(int(doc_id))
+        for doc_id, next_retry, dead in c.execute("SELECT doc_id, next_retry, dead FROM doc_failures"):
+            _failures[int(doc_id)] = (int(next_retry), bool(dead))
+        for doc_id, sha, stage, gate, meta in c.execute("SELECT doc_id, text_sha, stage, gate, meta FROM doc_state"):
+            _checkpoints[int(doc_id)] = {"sha": sha, "stage": stage,
+                                         "gate": json.loads(gate) if gate else None,
+                                         "meta": json.loads(meta) if meta else None}
+    log(f"Loaded {len(_done)} processed doc ids ({len(_done.bits) // 1024} KB)")
 
 def already_done(doc_id: int) -> bool:
-    with sqlite3.connect(DB_PATH) as c:
-        r = c.execute("SELECT doc_id FROM processed_docs WHERE doc_id=?", (doc_id,)).fetchone()
-        return r is not None
+    return doc_id in _done
+
+def already_done_many(doc_ids: list[int]) -> set[int]:
+    return {doc_id for doc_id in doc_ids if doc_id in _done}
 
 def mark_done(doc_id: int):
-    with sqlite3.connect(DB_PATH) as c:
-        c.execute("INSERT OR IGNORE INTO processed_docs(doc_id, processed_utc) VALUES(?,?)",
-                  (doc_id, int(time.time())))
+    """Committed every DB_COMMIT_EVERY calls; db_commit() at the end of each poll writes the rest."""
+    global _db_uncommitted
+    with _db_lock:
+        db().execute("INSERT OR IGNORE INTO processed_docs(doc_id, processed_utc) VALUES(?,?)",
+                     (doc_id, int(time.time())))
+        _done.add(doc_id)
+        metric_inc("forwarder_documents_total", result="processed")
+        if _failures.pop(doc_id, None) is not None:
+            db().execute("DELETE FROM doc_failures WHERE doc_id=?", (doc_id,))
+        if _checkpoints.pop(doc_id, None) is not None:
+            db().execute("DELETE FROM doc_state WHERE doc_id=?", (doc_id,))
+        _db_uncommitted += 1
+        if _db_uncommitted >= DB_COMMIT_EVERY:
+            db_commit()
+
+def forget_document(doc_id: int) -> None:
+    """Deleted from Paperless, or a webhook id that never existed: drop its retry/checkpoint state."""
+    global _db_uncommitted
+    with _db_lock:
+        if _failures.pop(doc_id, None) is not None:
+            db().execute("DELETE FROM doc_failures WHERE doc_id=?", (doc_id,))
+            _db_uncommitted += 1
+        if _checkpoints.pop(doc_id, None) is not None:
+            db().execute("DELETE FROM doc_state WHERE doc_id=?", (doc_id,))
+            _db_uncommitted += 1
+
+def get_cursor() -> tuple[str, int] | None:
+    with _db_lock:
+        r = db().execute("SELECT ts, doc_id FROM poll_cursor WHERE field=?", (POLL_CURSOR_FIELD,)).fetchone()
+        return (r[0], int(r[1])) if r else None
+
+def save_cursor(ts: str, doc_id: int):
+    global _db_uncommitted
+    with _db_lock:
+        db().execute("INSERT OR REPLACE INTO poll_cursor(field, ts, doc_id) VALUES(?,?,?)",
+                     (POLL_CURSOR_FIELD, ts, doc_id))
+        # commits pending mark_done rows as well, so the cursor never gets ahead of them
+        _db_uncommitted += 1
+        db_commit()
+
+def text_sha(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def load_checkpoint(doc_id: int, text: str) -> dict | None:
+    """Gate/meta of an earlier, interrupted attempt on the same OCR text (re-OCR starts over)."""
+    cp = _checkpoints.get(doc_id)
+    if cp is None or cp["sha"] != text_sha(text):
+        return None
+    return cp
+
+def save_checkpoint(doc_id: int, text: str, stage: str, gate: dict | None, meta: dict | None = None) -> None:
+    """
+    stage "gated" (gate model answered) or "extracted" (final meta known). Committed right
+    away: it stands for seconds of model time. Cleared by mark_done.
+    """
+    global _db_uncommitted
+    cp = {"sha": text_sha(text), "stage": stage, "gate": gate, "meta": meta}
+    with _db_lock:
+        db().execute("INSERT OR REPLACE INTO doc_state(doc_id, text_sha, stage, gate, meta, updated_utc) VALUES(?,?,?,?,?,?)",
+                     (doc_id, cp["sha"], stage, None if gate is None else json.dumps(gate),
+                      None if meta is None else json.dumps(meta), int(time.time())))
+        _checkpoints[doc_id] = cp
+        _db_uncommitted += 1
+        db_commit()
+
+class StageError(Exception):
+    """An exception tagged with the processing stage (fetch / llm / forward) it came from."""
+
+    def __init__(self, stage: str, error: Exception):
+        super().__init__(f"{stage}: {error!r}")
+        self.stage = stage
+        self.error = error
+
+class BackendUnavailable(RuntimeError):
+    """No Ollama endpoint could take the request (all down, breakers open, or all busy too long)."""
+
+def is_outage(err) -> bool:
+    """Paperless/Ollama unreachable or failing (5xx) rather than a problem with the document itself."""
+    if isinstance(err, (BackendUnavailable, requests.ConnectionError, requests.Timeout, ConnectionError,
+                        TimeoutError, asyncio.TimeoutError)):
+        return True
+    if isinstance(err, requests.HTTPError) and err.response is not None:
+        return err.response.status_code >= 500
+    if aiohttp is not None:
+        if isinstance(err, aiohttp.ClientResponseError):
+            return err.status >= 500
+        return isinstance(err, aiohttp.ClientConnectionError)
+    return False
+
+def record_failure(doc_id: int, err, stage: str = "process") -> None:
+    """
+    Counts a failed attempt for doc_id and schedules the next one with exponential backoff;
+    after DOC_MAX_ATTEMPTS the document becomes a dead letter and is no longer picked up.
+    Outages are retried on the same backoff step without counting, so documents arriving
+    while Ollama or Paperless is down do not end up as dead letters.
+    """
+    global _db_uncommitted
+    if isinstance(err, StageError):
+        stage, err = err.stage, err.error
+    outage = is_outage(err)
+    error = err if isinstance(err, str) else repr(err)
+    now = int(time.time())
+    with _db_lock:
+        c = db()
+        r = c.execute("SELECT attempts FROM doc_failures WHERE doc_id=?", (doc_id,)).fetchone()
+        attempts = (r[0] if r else 0) + (0 if outage else 1)
+        dead = attempts >= DOC_MAX_ATTEMPTS
+        delay = min(DOC_RETRY_BACKOFF * 2 ** max(attempts - 1, 0), DOC_RETRY_BACKOFF_MAX)
+        c.execute("""INSERT OR REPLACE INTO doc_failures(doc_id, stage, error, attempts, next_retry, dead, tagged, updated_utc)
+                     VALUES(?,?,?,?,?,?,0,?)""", (doc_id, stage, error[:1000], attempts, now + int(delay), int(dead), now))
+        _failures[doc_id] = (now + int(delay), dead)
+        _db_uncommitted += 1
+        db_commit()
+    metric_inc("forwarder_documents_total", result="dead" if dead else "failed")
+    metric_inc("forwarder_stage_errors_total", stage=stage)
+    if outage:
+        log(f"Doc {doc_id}: backend unavailable in {stage} stage (not counted), retry in {delay:.0f}s: {error}")
+    elif dead:
+        log(f"Doc {doc_id}: ERROR in {stage} stage (attempt {attempts}) -> dead letter: {error}")
+    else:
+        log(f"Doc {doc_id}: ERROR in {stage} stage (attempt {attempts}), retry in {delay:.0f}s: {error}")
+
+def retry_blocked(doc_id: int) -> bool:
+    """True for dead letters and for failed documents whose next retry is not due yet."""
+    f = _failures.get(doc_id)
+    return f is not None and (f[1] or f[0] > time.time())
+
+def due_retries() -> list[int]:
+    now = time.time()
+    return sorted(doc_id for doc_id, (next_retry, dead) in list(_failures.items()) if not dead and next_retry <= now)
+
+def tag_dead_letters(tags: dict) -> None:
+    """
+    One request per dead letter, so a document deleted in the meantime (or a webhook id that
+    never existed) cannot block the others; those count as handled.
+    """
+    global _db_uncommitted
+    with _db_lock:
+        ids = [r[0] for r in db().execute("SELECT doc_id FROM doc_failures WHERE dead=1 AND tagged=0")]
+    handled = []
+    for doc_id in ids:
+        try:
+            add_tags_to_documents([doc_id], [tags["failed"]])
+        except Exception as e:
+            if not paperless_gone(e):
+                log(f"Doc {doc_id}: could not tag dead letter, next poll: {e!r}")
+                continue
+            log(f"Doc {doc_id}: no longer in Paperless, dead letter left untagged")
+        handled.append(doc_id)
+    if handled:
+        with _db_lock:
+            db().executemany("UPDATE doc_failures SET tagged=1 WHERE doc_id=?", [(i,) for i in handled])
+            _db_uncommitted += 1
+        db_commit()
+
+def requeue_dead_letters() -> int:
+    """--retry-failed: gives every dead letter a fresh set of attempts."""
+    with _db_lock:
+        n = db().execute("DELETE FROM doc_failures WHERE dead=1").rowcount
+        db().commit()
+        for doc_id in [d for d, (_, dead) in _failures.items() if dead]:
+            del _failures[doc_id]
+    return n
+
+def llm_cache_key(payload: dict) -> str:
+    """
+    The prompt embeds both the template and the OCR text, so hashing it (plus model and
+    options) means a changed template or text is a miss and a re-scan with identical text a hit.
+    """
+    keyed = {k: v for k, v in payload.items() if k not in ("stream", "keep_alive")}
+    return hashlib.sha256(json.dumps(keyed, sort_keys=True).encode()).hexdigest()
+
+def llm_cache_get(key: str) -> dict | None:
+    if not LLM_CACHE:
+        return None
+    with _db_lock:
+        r = db().execute("SELECT result FROM llm_cache WHERE key=?", (key,)).fetchone()
+        if r is None:
+            return None
+        db().execute("UPDATE llm_cache SET used_utc=? WHERE key=?", (int(time.time()), key))
+    return json.loads(r[0])
+
+def llm_cache_put(key: str, model: str, result: dict) -> None:
+    if not LLM_CACHE:
+        return
+    blob = json.dumps(result)
+    now = int(time.time())
+    with _db_lock:
+        c = db()
+        c.execute("INSERT OR REPLACE INTO llm_cache(key, model, result, size, created_utc, used_utc) VALUES(?,?,?,?,?,?)",
+                  (key, model, blob, len(blob), now, now))
+        # evict least recently used entries down to 90% of the limit
+        limit = int(LLM_CACHE_MAX_MB * 1024 * 1024)
+        total = c.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total > limit:
+            drop, freed = [], 0
+            for k, size in c.execute("SELECT key, size FROM llm_cache ORDER BY used_utc"):
+                if total - freed <= limit * 0.9:
+                    break
+                drop.append((k,))
+                freed += size
+            c.executemany("DELETE FROM llm_cache WHERE key=?", drop)
         c.commit()
 
+# ---------------------------
+# Metrics
+# ---------------------------
+# Prometheus text format, served on /metrics by the HTTP listener
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+METRICS = {  # name -> (type, help)
+    "forwarder_stage_seconds": ("histogram", "Duration of each step (paperless_list/detail/download, gate, extract, tag, smtp)"),
+    "forwarder_sqlite_seconds": ("histogram", "SQLite operation duration"),
+    "forwarder_documents_total": ("counter", "Documents by outcome (processed, skipped, failed, dead)"),
+    "forwarder_stage_errors_total": ("counter", "Failed document attempts by stage"),
+    "forwarder_emails_total": ("counter", "Forwarding emails by outcome"),
+    "forwarder_llm_cache_hits_total": ("counter", "Gate/extract results served from the LLM cache"),
+    "forwarder_ollama_requests_total": ("counter", "Ollama requests by endpoint and outcome"),
+    "forwarder_ollama_eval_tokens_total": ("counter", "Tokens generated by Ollama"),
+    "forwarder_ollama_tokens_per_second": ("gauge", "Generation speed of the last Ollama response"),
+    "forwarder_ollama_ttft_seconds": ("histogram", "Time to first token (load + prompt eval)"),
+    "forwarder_ollama_prompt_tokens_total": ("counter", "Prompt tokens sent to Ollama"),
+    "forwarder_ollama_prompt_eval_tokens_total": ("counter", "Prompt tokens Ollama had to prefill (the rest came from its cache)"),
+    "forwarder_ollama_prompt_eval_seconds_total": ("counter", "Time Ollama spent on prefill"),
+    "forwarder_ollama_in_flight": ("gauge", "Requests running per Ollama endpoint"),
+    "forwarder_ollama_endpoint_up": ("gauge", "1 unless the endpoint's circuit breaker is open"),
+    "forwarder_queue_depth": ("gauge", "Items waiting per queue"),
+    "forwarder_poll_interval_seconds": ("gauge", "Current delay between Paperless sweeps"),
+}
+
+# (name, labels) -> value; histograms hold per-bucket counts + [sum, count]
+_metric_values: dict[tuple[str, tuple], float | list] = {}
+_metrics_lock = threading.Lock()
+
+def _metric_key(name: str, labels: dict) -> tuple[str, tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def metric_inc(name: str, value: float = 1.0, **labels) -> None:
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metric_values[key] = _metric_values.get(key, 0.0) + value
+
+def metric_set(name: str, value: float, **labels) -> None:
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metric_values[key] = float(value)
+
+def metric_observe(name: str, value: float, **labels) -> None:
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        h = _metric_values.get(key)
+        if h is None:
+            h = _metric_values[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+        i = bisect.bisect_left(METRIC_BUCKETS, value)
+        if i < len(METRIC_BUCKETS):
+            h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+@contextmanager
+def timed(name: str, **labels):
+    """Observes the duration of the block, also when it raises. Works around awaits too."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric_observe(name, time.perf_counter() - started, **labels)
+
+def _metric_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+def collect_gauges() -> None:
+    """Point-in-time values, read when /metrics is scraped."""
+    now = time.time()
+    retrying = sum(1 for _, dead in list(_failures.values()) if not dead)
+    with _pending_lock:
+        tags_pending = sum(len(v) for v in _pending_tags.values())
+    depths = {"webhook": len(_pushed), "outbox": outbox_pending(), "retry": retrying,
+              "dead_letter": len(_failures) - retrying, "checkpointed": len(_checkpoints), "tags": tags_pending}
+    if ENGINE == "pipeline" and LLM_SCHEDULE != "batched":
+        for name in ("pipeline_fetch", "pipeline_llm", "pipeline_forward"):
+            q = _queues.get(name)
+            depths[name] = q.qsize() if q is not None else 0
+    for name, n in depths.items():
+        metric_set("forwarder_queue_depth", n, queue=name)
+    with _nodes_cond:
+        for node in _nodes:
+            metric_set("forwarder_ollama_in_flight", node["in_flight"], endpoint=node["url"])
+            metric_set("forwarder_ollama_endpoint_up", int(node["open_until"] <= now), endpoint=node["url"])
+
+def render_metrics() -> str:
+    collect_gauges()
+    with _metrics_lock:
+        values = sorted((k, list(v) if isinstance(v, list) else v) for k, v in _metric_values.items())
+    out = []
+    for name, (kind, help_text) in METRICS.items():
+        series = [(labels, v) for (n, labels), v in values if n == name]
+        if not series:
+            continue
+        out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for labels, v in series:
+            if kind != "histogram":
+                out.append(f"{name}{_metric_labels(labels)} {v}")
+                continue
+            acc = 0
+            for bound, n in zip(METRIC_BUCKETS, v):
+                acc += n
+                out.append(f"{name}_bucket{_metric_labels(labels + (('le', str(bound)),))} {acc}")
+            out.append(f"{name}_bucket{_metric_labels(labels + (('le', '+Inf'),))} {v[-1]}")
+            out.append(f"{name}_sum{_metric_labels(labels)} {v[-2]}")
+            out.append(f"{name}_count{_metric_labels(labels)} {v[-1]}")
+    return "\n".join(out) + "\n"
+
 # ---------------------------
 # Paperless API
 # ---------------------------
-def paperless_headers():
-    return {"Authorization": f"Token {PAPERLESS_TOKEN}"}
+def paperless_gone(e: Exception) -> bool:
+    """The document does not exist (any more): 404 from its detail URL, 400 from bulk_edit."""
+    if aiohttp is not None and isinstance(e, aiohttp.ClientResponseError):
+        return e.status in (400, 404)
+    r = getattr(e, "response", None)
+    return isinstance(e, requests.HTTPError) and r is not None and r.status_code in (400, 404)
 
 def paperless_get_docs():
     url = f"{PAPERLESS_BASE_URL}/api/documents/"
     params = {"ordering": "-created", "page_size": MAX_DOCS}
-    r = requests.get(url, headers=paperless_headers(), params=params, timeout=60)
+    with timed("forwarder_stage_seconds", stage="paperless_list"):
+        r = paperless_http.get(url, params=params, timeout=60)
     r.raise_for_status()
     data = r.json()
     return data.get("results", data)
 
+def paperless_iter_pages(url: str, params: dict | None = None):
+    """Yields the result list of every page, following the `next` links."""
+    while url:
+        with timed("forwarder_stage_seconds", stage="paperless_list"):
+            r = paperless_http.get(url, params=params, timeout=60)
+        r.raise_for_status()
+        data = r.json()
+        if isinstance(data, list):
+            yield data
+            return
+        yield data.get("results") or []
+        url = data.get("next")
+        params = None  # `next` already carries the query string
+
+def cursor_key(d: dict) -> tuple:
+    return (datetime.fromisoformat(d[POLL_CURSOR_FIELD].replace("Z", "+00:00")), int(d["id"]))
+
+def paperless_get_docs_since(cursor: tuple[str, int] | None):
+    """
+    Yields documents newer than the cursor, oldest first, across all pages.
+    Without a cursor (first start) only the newest MAX_DOCS are returned, like the latest mode.
+    """
+    url = f"{PAPERLESS_BASE_URL}/api/documents/"
+    fields = f"id,{POLL_CURSOR_FIELD}"
+    if cursor is None:
+        params = {"ordering": f"-{POLL_CURSOR_FIELD}", "page_size": MAX_DOCS, "fields": fields}
+        with timed("forwarder_stage_seconds", stage="paperless_list"):
+            r = paperless_http.get(url, params=params, timeout=60)
+        r.raise_for_status()
+        data = r.json()
+        yield from sorted(data.get("results", data), key=cursor_key)
+        return
+
+    # __gte + tuple compare: documents sharing the cursor timestamp are not lost
+    params = {
+        "ordering": f"{POLL_CURSOR_FIELD},id",
+        "page_size": PAGE_SIZE,
+        "fields": fields,
+        f"{POLL_CURSOR_FIELD}__gte": cursor[0],
+    }
+    last = cursor_key({POLL_CURSOR_FIELD: cursor[0], "id": cursor[1]})
+    for page in paperless_iter_pages(url, params):
+        for d in page:
+            if cursor_key(d) > last:
+                yield d
+
 def paperless_get_doc_detail(doc_id: int) -> dict:
     url = f"{PAPERLESS_BASE_URL}/api/documents/{doc_id}/"
-    r = requests.get(url, headers=paperless_headers(), timeout=60)
+    with timed("forwarder_stage_seconds", stage="paperless_detail"):
+        r = paperless_http.get(url, timeout=60)
     r.raise_for_status()
     return r.json()
 
@@ -109,7 +789,8 @@ def paperless_get_text(doc_id: int) -> str:
 
 def download_pdf_bytes(doc_id: int) -> bytes:
     url = PAPERLESS_BASE_URL + PAPERLESS_DOWNLOAD_PATH_TEMPLATE.format(id=doc_id)
-    r = requests.get(url, headers=paperless_headers(), timeout=180)
+    with timed("forwarder_stage_seconds", stage="paperless_download"):
+        r = paperless_http.get(url, timeout=180)
     r.raise_for_status()
     return r.content
 
@@ -117,40 +798,427 @@ def download_pdf_bytes(doc_id: int) -> bytes:
 # Tagging
 # ---------------------------
 def get_or_create_tag_id(tag_name: str) -> int:
-    h = paperless_headers()
-    r = requests.get(f"{PAPERLESS_BASE_URL}/api/tags/", headers=h, params={"name__iexact": tag_name}, timeout=30)
+    r = paperless_http.get(f"{PAPERLESS_BASE_URL}/api/tags/", params={"name__iexact": tag_name}, timeout=30)
     r.raise_for_status()
     data = r.json()
     results = data.get("results", data)
     if results:
         return int(results[0]["id"])
-    r = requests.post(f"{PAPERLESS_BASE_URL}/api/tags/", headers=h, json={"name": tag_name}, timeout=30)
+    r = paperless_http.post(f"{PAPERLESS_BASE_URL}/api/tags/", json={"name": tag_name}, timeout=30)
     r.raise_for_status()
     return int(r.json()["id"])
 
-def add_tags_to_document(doc_id: int, tag_ids: list[int]) -> None:
-    h = paperless_headers()
-    r = requests.get(f"{PAPERLESS_BASE_URL}/api/documents/{doc_id}/", headers=h, timeout=30)
-    r.raise_for_status()
-    doc = r.json()
-    current = set(doc.get("tags", []) or [])
-    new = sorted(current.union(set(tag_ids)))
-    r = requests.patch(f"{PAPERLESS_BASE_URL}/api/documents/{doc_id}/", headers=h, json={"tags": new}, timeout=30)
+def bulk_edit_payload(doc_ids: list[int], tag_ids: list[int]) -> dict:
+    # modify_tags adds server side, so tags set by someone else in the meantime are kept
+    return {
+        "documents": sorted(doc_ids),
+        "method": "modify_tags",
+        "parameters": {"add_tags": sorted(set(tag_ids)), "remove_tags": []},
+    }
+
+def add_tags_to_documents(doc_ids: list[int], tag_ids: list[int]) -> None:
+    """One bulk_edit request instead of GET + PATCH per document."""
+    with timed("forwarder_stage_seconds", stage="tag"):
+        r = paperless_http.post(f"{PAPERLESS_BASE_URL}/api/documents/bulk_edit/",
+                                json=bulk_edit_payload(doc_ids, tag_ids), timeout=60)
     r.raise_for_status()
 
+# TAG_BATCH_SIZE > 0: final tag sets are collected and written at the end of a batch,
+# one bulk_edit call per distinct tag set. Lost if the process dies before the flush.
+_pending_tags: dict[tuple, list[int]] = {}
+_pending_lock = threading.Lock()
+
+def queue_tags(doc_id: int, tag_ids: list[int]) -> None:
+    with _pending_lock:
+        _pending_tags.setdefault(tuple(sorted(set(tag_ids))), []).append(doc_id)
+        n = sum(len(v) for v in _pending_tags.values())
+    if n >= TAG_BATCH_SIZE:
+        flush_tags()
+
+def flush_tags() -> None:
+    """
+    One bulk_edit per tag set. A set that fails for a reason other than an outage is retried
+    document by document, so one bad id cannot hold back the rest; ids Paperless no longer
+    knows (400/404) are dropped, everything else that failed is kept for the next flush.
+    """
+    with _pending_lock:
+        pending = list(_pending_tags.items())
+        _pending_tags.clear()
+    kept: dict[tuple, list[int]] = {}
+    for tag_set, doc_ids in pending:
+        try:
+            add_tags_to_documents(doc_ids, list(tag_set))
+            log(f"Tagged {len(doc_ids)} docs with {list(tag_set)}")
+            continue
+        except Exception as e:
+            if is_outage(e) or len(doc_ids) == 1:
+                if paperless_gone(e):
+                    log(f"Doc {doc_ids[0]}: no longer in Paperless, tags {list(tag_set)} dropped")
+                else:
+                    log(f"Tagging {len(doc_ids)} docs failed, kept for the next flush: {e!r}")
+                    kept[tag_set] = doc_ids
+                continue
+        for doc_id in doc_ids:
+            try:
+                add_tags_to_documents([doc_id], list(tag_set))
+            except Exception as e:
+                if paperless_gone(e):
+                    log(f"Doc {doc_id}: no longer in Paperless, tags {list(tag_set)} dropped")
+                else:
+                    log(f"Doc {doc_id}: tagging failed, kept for the next flush: {e!r}")
+                    kept.setdefault(tag_set, []).append(doc_id)
+    if kept:
+        with _pending_lock:
+            for tag_set, doc_ids in kept.items():
+                _pending_tags.setdefault(tag_set, []).extend(doc_ids)
+
+def tag_document(doc_id: int, tag_ids: list[int]) -> None:
+    if TAG_BATCH_SIZE > 0:
+        queue_tags(doc_id, tag_ids)
+    else:
+        add_tags_to_documents([doc_id], tag_ids)
+
+# ---------------------------
+# Ollama endpoints
+# ---------------------------
+def model_name(model: str) -> str:
+    return model if ":" in model else f"{model}:latest"  # how /api/ps reports untagged models
+
+def parse_pins(spec: str) -> dict[str, set[str]]:
+    pins = {}
+    for part in filter(None, (p.strip() for p in spec.split(";"))):
+        model, _, urls = part.partition("=")
+        pins[model_name(model.strip())] = {u.strip().rstrip("/") for u in urls.split("|") if u.strip()}
+    return pins
+
+_pins = parse_pins(OLLAMA_PIN)
+_nodes = [{"url": u, "in_flight": 0, "failures": 0, "open_until": 0.0, "loaded": set()} for u in OLLAMA_URLS]
+_nodes_cond = threading.Condition()
+
+def _node_rank(node: dict, model: str) -> int:
+    # 0 = model already loaded there, 1 = nothing loaded yet, 2 = would push out another model
+    if model in node["loaded"]:
+        return 0
+    return 1 if not node["loaded"] else 2
+
+def acquire_node(model: str, exclude=(), timeout: float = 900.0) -> dict:
+    """
+    Reserves a slot on the endpoint with the best model affinity, then the fewest requests
+    in flight. Endpoints holding another model are only used when no better one is healthy,
+    so with two nodes the gate and extract models settle on one node each. Waits while the
+    suitable endpoints are at OLLAMA_NODE_CONCURRENCY; raises when none is healthy.
+    OLLAMA_PIN narrows the choice to fixed servers for a model while one of them is up.
+    """
+    model = model_name(model)
+    deadline = time.time() + timeout
+    with _nodes_cond:
+        while True:
+            now = time.time()
+            healthy = [n for n in _nodes if n["url"] not in exclude and n["open_until"] <= now]
+            pinned = [n for n in healthy if n["url"] in _pins.get(model, ())]
+            healthy = pinned or healthy
+            if not healthy:
+                raise BackendUnavailable(f"No healthy Ollama endpoint for {model}")
+            allowed = max(1, min(_node_rank(n, model) for n in healthy))
+            free = [n for n in healthy
+                    if _node_rank(n, model) <= allowed and n["in_flight"] < OLLAMA_NODE_CONCURRENCY]
+            if free:
+                node = min(free, key=lambda n: (_node_rank(n, model), n["in_flight"]))
+                node["in_flight"] += 1
+                return node
+            if now >= deadline:
+                raise BackendUnavailable(f"Timed out waiting for an Ollama endpoint for {model}")
+            _nodes_cond.wait(min(deadline - now, 1.0))  # wake up now and then to re-check breakers
+
+def _node_result(node: dict, ok: bool) -> None:
+    # caller holds _nodes_cond
+    if ok:
+        if node["open_until"]:
+            log(f"Ollama {node['url']}: healthy again")
+        node["failures"] = 0
+        node["open_until"] = 0.0
+        return
+    node["failures"] += 1
+    if node["failures"] >= OLLAMA_BREAKER_FAILURES:
+        if node["open_until"] <= time.time():
+            log(f"Ollama {node['url']}: {node['failures']} failures -> paused for {OLLAMA_BREAKER_SECONDS}s")
+        node["open_until"] = time.time() + OLLAMA_BREAKER_SECONDS
+
+def release_node(node: dict, model: str, ok: bool | None) -> None:
+    """ok=None: the request failed for a reason unrelated to the endpoint (e.g. bad model output)."""
+    with _nodes_cond:
+        node["in_flight"] -= 1
+        if ok is not None:
+            _node_result(node, ok)
+            metric_inc("forwarder_ollama_requests_total", endpoint=node["url"], result="ok" if ok else "error")
+        if ok:
+            node["loaded"].add(model_name(model))
+        _nodes_cond.notify_all()
+
+def ollama_call(model: str, fn):
+    """Runs fn(base_url) on a balanced endpoint, failing over to the next one on connection/HTTP errors."""
+    tried = set()
+    while True:
+        node = acquire_node(model, tried)
+        try:
+            out = fn(node["url"])
+        except requests.RequestException as e:
+            release_node(node, model, False)
+            tried.add(node["url"])
+            if len(tried) >= len(_nodes):
+                raise
+            log(f"Ollama {node['url']}: {e!r} -> next endpoint")
+            continue
+        except Exception:
+            release_node(node, model, None)
+            raise
+        release_node(node, model, True)
+        return out
+
+def check_ollama_node(node: dict) -> bool:
+    """Liveness via /api/tags; /api/ps (newer Ollama) tells which models are loaded for affinity."""
+    try:
+        ollama_http.get(f"{node['url']}/api/tags", timeout=5).raise_for_status()
+        ok = True
+    except Exception:
+        ok = False
+    loaded = None
+    if ok:
+        try:
+            r = ollama_http.get(f"{node['url']}/api/ps", timeout=5)
+            if r.status_code == 200:
+                loaded = {m.get("name") or m.get("model") for m in r.json().get("models") or []}
+        except Exception:
+            pass
+    with _nodes_cond:
+        if ok:
+            _node_result(node, True)
+            if loaded is not None:
+                node["loaded"] = loaded
+        elif node["open_until"] <= time.time():
+            node["failures"] = max(node["failures"], OLLAMA_BREAKER_FAILURES - 1)
+            _node_result(node, False)
+        _nodes_cond.notify_all()
+    return ok
+
+def ollama_health_loop():
+    while True:
+        time.sleep(OLLAMA_HEALTH_SECONDS)
+        for node in _nodes:
+            check_ollama_node(node)
+
 # ---------------------------
 # Ollama
 # ---------------------------
-def ollama_generate(model: str, prompt: str) -> dict:
+def ollama_payload(model: str, prompt: str, schema: dict | None = None, num_predict: int | None = None,
+                   system: str | None = None) -> dict:
     payload = {"model": model, "prompt": prompt, "stream": False, "options": {"temperature": 0.1}}
-    r = requests.post(f"{OLLAMA_BASE_URL}/api/generate", json=payload, timeout=900)
+    if system:
+        payload["system"] = system
+    if schema and OLLAMA_FORMAT == "schema":
+        payload["format"] = schema
+    elif OLLAMA_FORMAT in ("schema", "json"):
+        payload["format"] = "json"
+    if num_predict:
+        payload["options"]["num_predict"] = num_predict
+    if OLLAMA_KEEP_ALIVE:
+        payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+    return payload
+
+class OllamaStream:
+    """
+    Consumes /api/generate stream chunks. feed() returns True one chunk after the first
+    top-level JSON object in the output is closed (or when the model is done), so the caller
+    can hang up and Ollama stops generating whatever the model would ramble on with. The extra
+    chunk is usually the final one (schema decoding ends right after the object) and carries
+    the prompt-eval stats.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.started = time.time()
+        self.first_token = None
+        self.tokens = 0
+        self.parts = []
+        self.final = {}
+        self.early = False
+        self.closed = False
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+
+    def _scan(self, piece: str) -> int:
+        """Index in piece where the top-level object closes, or -1."""
+        for i, ch in enumerate(piece):
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"' and self._depth:
+                self._in_str = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}" and self._depth:
+                self._depth -= 1
+                if not self._depth:
+                    return i
+        return -1
+
+    def feed(self, chunk: dict) -> bool:
+        if chunk.get("error"):
+            raise RuntimeError(f"Ollama error: {chunk['error']}")
+        if self.closed:
+            if chunk.get("done"):
+                self.final = chunk
+            else:
+                self.early = True
+            return True
+        piece = chunk.get("response") or ""
+        if piece:
+            if self.first_token is None:
+                self.first_token = time.time()
+            self.tokens += 1
+            end = self._scan(piece)
+            if end != -1:
+                self.parts.append(piece[:end + 1])
+                self.closed = True
+            else:
+                self.parts.append(piece)
+        if chunk.get("done"):
+            self.final = chunk
+            return True
+        return False
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def log_stats(self):
+        ttft = (self.first_token or time.time()) - self.started
+        gen_s = time.time() - (self.first_token or time.time())
+        tps = self.tokens / gen_s if gen_s > 0 else 0.0
+        if self.final.get("eval_duration"):
+            tps = self.final.get("eval_count", 0) / (self.final["eval_duration"] / 1e9)
+        log_llm_stats(self.model, ttft, self.tokens, tps, self.early)
+        record_prompt_stats(self.model, self.final)
+
+def log_llm_stats(model: str, ttft: float, tokens: int, tps: float, early: bool = False):
+    log(f"Ollama {model}: ttft={ttft:.2f}s tokens={tokens} ({tps:.1f} tok/s)" + (" stopped early" if early else ""))
+    metric_observe("forwarder_ollama_ttft_seconds", ttft, model=model)
+    metric_inc("forwarder_ollama_eval_tokens_total", tokens, model=model)
+    metric_set("forwarder_ollama_tokens_per_second", tps, model=model)
+
+_prompt_stats: dict[str, dict] = {}
+_prompt_stats_lock = threading.Lock()
+
+def record_prompt_stats(model: str, final: dict) -> None:
+    """
+    Prompt tokens = len(context) - eval_count (context is the whole conversation in tokens);
+    whatever Ollama did not have to prefill (prompt_eval_count) came from its prompt cache.
+    """
+    if not final or "prompt_eval_count" not in final:
+        return
+    evaluated = int(final.get("prompt_eval_count") or 0)
+    total = len(final.get("context") or []) - int(final.get("eval_count") or 0)
+    total = max(total, evaluated)
+    prefill = (final.get("prompt_eval_duration") or 0) / 1e9
+    metric_inc("forwarder_ollama_prompt_tokens_total", total, model=model)
+    metric_inc("forwarder_ollama_prompt_eval_tokens_total", evaluated, model=model)
+    metric_inc("forwarder_ollama_prompt_eval_seconds_total", prefill, model=model)
+    with _prompt_stats_lock:
+        st = _prompt_stats.setdefault(model, {"calls": 0, "prompt_tokens": 0, "evaluated": 0, "prefill_s": 0.0})
+        st["calls"] += 1
+        st["prompt_tokens"] += total
+        st["evaluated"] += evaluated
+        st["prefill_s"] += prefill
+        saved = st["prompt_tokens"] - st["evaluated"]
+        share = saved / st["prompt_tokens"] if st["prompt_tokens"] else 0.0
+        log(f"Ollama {model}: prompt={total} prefilled={evaluated} cached={total - evaluated} ({prefill:.2f}s); "
+            f"total saved={saved} tokens ({share:.0%}) over {st['calls']} calls")
+
+def ollama_stream(base: str, model: str, payload: dict) -> str:
+    stream = OllamaStream(model)
+    r = ollama_http.post(f"{base}/api/generate", json={**payload, "stream": True}, timeout=900, stream=True)
+    try:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if line and stream.feed(json.loads(line)):
+                break
+    finally:
+        r.close()  # drops the connection if we stopped early, which cancels the generation
+    stream.log_stats()
+    return stream.text()
+
+def ollama_post(base: str, payload: dict) -> dict:
+    r = ollama_http.post(f"{base}/api/generate", json=payload, timeout=900)
     r.raise_for_status()
-    out = (r.json().get("response") or "").strip()
+    return r.json()
+
+def ollama_generate(model: str, prompt: str, schema: dict | None = None, num_predict: int | None = None,
+                    system: str | None = None) -> dict:
+    payload = ollama_payload(model, prompt, schema, num_predict, system)
+    key = llm_cache_key(payload)
+    cached = llm_cache_get(key)
+    if cached is not None:
+        log(f"LLM cache hit ({model})")
+        metric_inc("forwarder_llm_cache_hits_total", model=model)
+        return cached
+    if OLLAMA_STREAM:
+        out = ollama_call(model, lambda base: ollama_stream(base, model, payload))
+    else:
+        data = ollama_call(model, lambda base: ollama_post(base, payload))
+        eval_s = data.get("eval_duration", 0) / 1e9
+        log_llm_stats(model, (data.get("load_duration", 0) + data.get("prompt_eval_duration", 0)) / 1e9,
+                      data.get("eval_count", 0), data.get("eval_count", 0) / eval_s if eval_s else 0.0)
+        record_prompt_stats(model, data)
+        out = data.get("response") or ""
+    result = parse_model_json(out)
+    if schema:
+        result = validate_result(result, schema)
+    llm_cache_put(key, model, result)
+    return result
+
+def parse_model_json(out: str) -> dict:
+    out = out.strip()
     a, b = out.find("{"), out.rfind("}")
     if a == -1 or b == -1:
         raise ValueError(f"Model did not return JSON. First 200 chars: {out[:200]}")
     return json.loads(out[a:b+1])
 
+def _coerce(name: str, v, spec: dict):
+    t = spec["type"]
+    if t == "boolean":
+        if isinstance(v, str):
+            if v.strip().lower() not in ("true", "false", "yes", "no", "1", "0", ""):
+                raise ValueError(f"Model returned non-boolean {name}={v!r}")
+            return v.strip().lower() in ("true", "yes", "1")
+        return bool(v)
+    if t == "number":
+        if isinstance(v, str) and not v.strip():
+            return 0.0
+        try:
+            x = float(str(v).replace(",", ".")) if isinstance(v, str) else float(v)
+        except (TypeError, ValueError):
+            raise ValueError(f"Model returned non-numeric {name}={v!r}") from None
+        return min(max(x, spec.get("minimum", x)), spec.get("maximum", x))
+    return "" if v is None else str(v)
+
+def validate_result(data, schema: dict) -> dict:
+    """
+    Checks model output against a flat object schema and returns it with every property
+    present and of the declared type. Missing fields get empty defaults (as the old
+    meta.get(..., default) reads did); unknown fields are dropped.
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"Model returned {type(data).__name__}, expected an object")
+    empty = {"boolean": False, "number": 0.0, "string": ""}
+    return {
+        name: _coerce(name, data[name], spec) if data.get(name) is not None else empty[spec["type"]]
+        for name, spec in schema["properties"].items()
+    }
+
 def contains_any(text: str, kws) -> bool:
     t = (text or "").lower()
     return any(k in t for k in kws if k)
@@ -172,18 +1240,296 @@ def matches_specific_iban(text: str) -> bool:
 # ---------------------------
 # Email
 # ---------------------------
-def send_email_with_pdf(to_addr: str, subject: str, body: str, filename: str, pdf_bytes: bytes):
+def build_email(to_addr: str, subject: str, body: str, filename: str, pdf_bytes: bytes,
+                message_id: str | None = None) -> EmailMessage:
     msg = EmailMessage()
+    if message_id:
+        msg["Message-ID"] = message_id
     msg["From"] = MAIL_FROM
     msg["To"] = to_addr
     msg["Subject"] = subject
     msg.set_content(body)
     msg.add_attachment(pdf_bytes, maintype="application", subtype="pdf", filename=filename)
+    return msg
 
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as s:
+def build_digest(to_addr: str, items: list[dict], message_id: str | None = None) -> EmailMessage:
+    """One email carrying several forwarded invoices for the same mailbox."""
+    msg = EmailMessage()
+    if message_id:
+        msg["Message-ID"] = message_id
+    msg["From"] = MAIL_FROM
+    msg["To"] = to_addr
+    msg["Subject"] = f"Invoices from Paperless ({len(items)}): " + ", ".join(f"#{it['doc_id']}" for it in items)
+    msg.set_content(("\n" + "-" * 40 + "\n\n").join(f"{it['subject']}\n\n{it['body']}" for it in items))
+    for it in items:
+        msg.add_attachment(it["pdf"], maintype="application", subtype="pdf", filename=it["filename"])
+    return msg
+
+# One authenticated session shared by all senders: the provider throttles logins.
+_smtp = None
+_smtp_used = 0.0
+_smtp_lock = threading.Lock()
+
+def smtp_close() -> None:
+    global _smtp
+    with _smtp_lock:
+        if _smtp is not None:
+            try:
+                _smtp.quit()
+            except Exception:
+                _smtp.close()
+            _smtp = None
+
+def _smtp_session() -> smtplib.SMTP:
+    # caller holds _smtp_lock
+    global _smtp
+    if _smtp is not None and time.time() - _smtp_used > SMTP_NOOP_SECONDS:
+        try:
+            ok = _smtp.noop()[0] == 250
+        except Exception:
+            ok = False
+        if not ok:
+            _smtp.close()
+            _smtp = None
+    if _smtp is None:
+        s = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=60)
         s.starttls()
         s.login(SMTP_USER, SMTP_PASS)
-        s.send_message(msg)
+        log(f"SMTP session opened ({SMTP_HOST})")
+        _smtp = s
+    return _smtp
+
+def smtp_send(msg: EmailMessage) -> None:
+    """Sends on the shared session, reconnecting once if the server dropped it."""
+    global _smtp, _smtp_used
+    with _smtp_lock, timed("forwarder_stage_seconds", stage="smtp"):
+        for attempt in (1, 2):
+            s = _smtp_session()
+            try:
+                s.send_message(msg)
+                _smtp_used = time.time()
+                metric_inc("forwarder_emails_total", result="sent")
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as e:  # not SMTP errors, those are OSErrors too
+                s.close()
+                _smtp = None
+                if attempt == 2:
+                    raise
+                log(f"SMTP session lost ({e!r}) -> reconnecting")
+
+def smtp_keepalive() -> None:
+    """Called between polls: NOOP keeps the session warm, long idle or dead sessions are closed."""
+    with _smtp_lock:
+        if _smtp is None or time.time() - _smtp_used <= SMTP_IDLE_SECONDS:
+            try:
+                alive = _smtp is None or _smtp.noop()[0] == 250
+            except Exception:
+                alive = False
+            if alive:
+                return
+    smtp_close()
+
+def send_email_with_pdf(to_addr: str, subject: str, body: str, filename: str, pdf_bytes: bytes,
+                        message_id: str | None = None):
+    smtp_send(build_email(to_addr, subject, body, filename, pdf_bytes, message_id))
+
+# ---------------------------
+# Outbox
+# ---------------------------
+# Forwarding emails are queued in state.sqlite together with the document's processed_docs row
+# and delivered by a separate worker, so an SMTP outage delays mail instead of re-running the LLM.
+# Delivery is at-least-once: a crash after the server accepted a mail but before its row's DELETE
+# is committed sends it again. The copy carries the same Message-ID, so mail clients can drop it.
+# Sent rows stay (sent=1) until the document's tags are written, so a Paperless outage after
+# delivery delays the tags instead of losing them.
+_outbox_wake = threading.Event()
+_outbox_send_lock = threading.Lock()  # one delivery round at a time (worker or backfill drain)
+
+def queue_email(doc_id: int, recipients: list[str], subject: str, body: str, filename: str,
+                sent_tags: list[int]) -> None:
+    """
+    sent_tags are applied once every copy of the document went out. In digest mode rows are
+    held (next_attempt NULL) until release_outbox() at the end of the batch.
+    """
+    global _db_uncommitted
+    now = int(time.time())
+    with _db_lock:
+        db().executemany(
+            """INSERT INTO outbox(doc_id, recipient, subject, body, filename, tags, attempts, next_attempt, created_utc)
+               VALUES(?,?,?,?,?,?,0,?,?)""",
+            [(doc_id, to_addr, subject, body, filename, json.dumps(sent_tags), None if SMTP_DIGEST else now, now)
+             for to_addr in recipients])
+        _db_uncommitted += 1
+    if not SMTP_DIGEST:
+        _outbox_wake.set()
+
+def release_outbox() -> None:
+    """Makes held digest rows due and wakes the sender."""
+    with _db_lock:
+        n = db().execute("UPDATE outbox SET next_attempt=? WHERE next_attempt IS NULL", (int(time.time()),)).rowcount
+    if n:
+        db_commit()
+    _outbox_wake.set()
+
+def outbox_pending() -> int:
+    with _db_lock:
+        return db().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+def _outbox_groups(rows: list[dict]) -> list[list[dict]]:
+    if not SMTP_DIGEST:
+        return [[r] for r in rows]
+    groups, by_to = [], {}
+    for r in rows:
+        g = by_to.get(r["recipient"])
+        if g is None or len(g) >= SMTP_DIGEST_MAX_DOCS:
+            g = by_to[r["recipient"]] = []
+            groups.append(g)
+        g.append(r)
+    return groups
+
+def _outbox_retry(rows: list[dict], err: Exception) -> None:
+    global _db_uncommitted
+    now = int(time.time())
+    with _db_lock:
+        for r in rows:
+            delay = min(OUTBOX_BACKOFF * 2 ** r["attempts"], OUTBOX_BACKOFF_MAX)
+            db().execute("UPDATE outbox SET attempts=attempts+1, next_attempt=?, last_error=? WHERE id=?",
+                         (now + int(delay), repr(err)[:500], r["id"]))
+            log(f"Doc {r['doc_id']}: email to {r['recipient']} failed (attempt {r['attempts'] + 1}), "
+                f"retry in {delay:.0f}s: {err!r}")
+        _db_uncommitted += 1
+    db_commit()
+    metric_inc("forwarder_emails_total", len(rows), result="failed")
+
+def _outbox_drop(r: dict) -> None:
+    global _db_uncommitted
+    with _db_lock:
+        db().execute("DELETE FROM outbox WHERE id=?", (r["id"],))
+        _db_uncommitted += 1
+    db_commit()
+    log(f"Doc {r['doc_id']}: no longer in Paperless, email to {r['recipient']} dropped")
+    metric_inc("forwarder_emails_total", result="dropped")
+
+def outbox_message_id(rows: list[dict]) -> str:
+    """Stable per outbox row (or digest of rows), so a re-send after a crash is recognisable."""
+    key = ",".join(f"{r['id']}:{r['doc_id']}:{r['recipient']}" for r in sorted(rows, key=lambda r: r["id"]))
+    domain = MAIL_FROM.rpartition("@")[2] if "@" in MAIL_FROM else "localhost"
+    return f"<paperless-outbox-{hashlib.blake2b(key.encode(), digest_size=10).hexdigest()}@{domain}>"
+
+def _outbox_delivered(rows: list[dict]) -> None:
+    """Sent rows stay as sent=1 until their document's tags are written (_outbox_tag)."""
+    global _db_uncommitted
+    with _db_lock:
+        db().executemany("UPDATE outbox SET sent=1, attempts=0, last_error=NULL WHERE id=?",
+                         [(r["id"],) for r in rows])
+        _db_uncommitted += 1
+    db_commit()
+
+def _outbox_tag_done(doc_ids: list[int], tag_ids: list[int], err: Exception | None) -> None:
+    """Drops the sent rows of tagged (or deleted) documents, backs off the others."""
+    global _db_uncommitted
+    now = int(time.time())
+    with _db_lock:
+        for doc_id in doc_ids:
+            if err is None or paperless_gone(err):
+                db().execute("DELETE FROM outbox WHERE doc_id=? AND sent=1", (doc_id,))
+                if err is None:
+                    log(f"Doc {doc_id}: forwarded")
+                else:
+                    log(f"Doc {doc_id}: no longer in Paperless, tags {tag_ids} dropped")
+                continue
+            attempts = db().execute("SELECT MAX(attempts) FROM outbox WHERE doc_id=? AND sent=1",
+                                    (doc_id,)).fetchone()[0] or 0
+            delay = min(OUTBOX_BACKOFF * 2 ** attempts, OUTBOX_BACKOFF_MAX)
+            db().execute("UPDATE outbox SET attempts=attempts+1, next_attempt=?, last_error=? WHERE doc_id=? AND sent=1",
+                         (now + int(delay), repr(err)[:500], doc_id))
+            log(f"Doc {doc_id}: emailed, tagging failed (attempt {attempts + 1}), retry in {delay:.0f}s: {err!r}")
+        _db_uncommitted += 1
+    db_commit()
+
+def _outbox_tag() -> None:
+    """
+    Applies the sent-tags of every document whose emails all went out, one bulk_edit per tag
+    set. Like flush_tags, a failing set is retried per document unless Paperless is down.
+    """
+    with _db_lock:
+        rows = db().execute(
+            """SELECT DISTINCT doc_id, tags FROM outbox WHERE sent=1 AND next_attempt <= ?
+               AND doc_id NOT IN (SELECT doc_id FROM outbox WHERE sent=0)""", (int(time.time()),)).fetchall()
+    groups: dict[tuple, list[int]] = {}
+    for doc_id, tags in rows:
+        groups.setdefault(tuple(sorted(set(json.loads(tags)))), []).append(int(doc_id))
+    for tag_set, doc_ids in groups.items():
+        try:
+            add_tags_to_documents(doc_ids, list(tag_set))
+            _outbox_tag_done(doc_ids, list(tag_set), None)
+            continue
+        except Exception as e:
+            if is_outage(e) or len(doc_ids) == 1:
+                _outbox_tag_done(doc_ids, list(tag_set), e)
+                continue
+        for doc_id in doc_ids:
+            try:
+                add_tags_to_documents([doc_id], list(tag_set))
+                _outbox_tag_done([doc_id], list(tag_set), None)
+            except Exception as e:
+                _outbox_tag_done([doc_id], list(tag_set), e)
+
+def send_outbox() -> int:
+    """Delivers every due row (digests per recipient in digest mode). Returns how many went out."""
+    sent = 0
+    with _outbox_send_lock:
+        while True:
+            with _db_lock:
+                cur = db().execute(
+                    """SELECT id, doc_id, recipient, subject, body, filename, tags, attempts FROM outbox
+                       WHERE sent=0 AND next_attempt <= ? ORDER BY next_attempt, id LIMIT 100""", (int(time.time()),))
+                cols = [d[0] for d in cur.description]
+                rows = [dict(zip(cols, r)) for r in cur.fetchall()]
+            for group in _outbox_groups(rows):
+                items = []
+                for r in group:
+                    try:
+                        items.append({**r, "pdf": download_pdf_bytes(r["doc_id"])})
+                    except Exception as e:
+                        if paperless_gone(e):
+                            _outbox_drop(r)
+                        else:
+                            _outbox_retry([r], e)
+                if not items:
+                    continue
+                try:
+                    if len(items) == 1:
+                        it = items[0]
+                        send_email_with_pdf(it["recipient"], it["subject"], it["body"], it["filename"], it["pdf"],
+                                            outbox_message_id(items))
+                    else:
+                        smtp_send(build_digest(items[0]["recipient"], items, outbox_message_id(items)))
+                        log(f"Digest to {items[0]['recipient']}: {len(items)} invoices sent")
+                except Exception as e:
+                    _outbox_retry(items, e)
+                    continue
+                _outbox_delivered(items)
+                sent += len(items)
+            _outbox_tag()
+            if not rows:
+                break
+    return sent
+
+def outbox_worker():
+    while True:
+        _outbox_wake.wait(OUTBOX_POLL_SECONDS)
+        _outbox_wake.clear()
+        try:
+            send_outbox()
+        except Exception as e:
+            log("Outbox: ERROR", repr(e))
+
+def start_outbox_worker() -> None:
+    n = outbox_pending()
+    if n:
+        log(f"Outbox: {n} emails pending")
+    threading.Thread(target=outbox_worker, name="outbox", daemon=True).start()
 
 # ---------------------------
 # Startup waits
@@ -192,7 +1538,7 @@ def wait_for_paperless():
     url = f"{PAPERLESS_BASE_URL}/api/"
     for _ in range(90):
         try:
-            r = requests.get(url, headers=paperless_headers(), timeout=5)
+            r = paperless_http.get(url, timeout=5)
             if r.status_code in (200, 401, 403):
                 log("Paperless reachable:", r.status_code)
                 return
@@ -202,15 +1548,13 @@ def wait_for_paperless():
     raise RuntimeError("Paperless not reachable after waiting")
 
 def wait_for_ollama():
-    url = f"{OLLAMA_BASE_URL}/api/tags"
+    """Waits until at least one endpoint answers, then keeps checking all of them in the background."""
     for _ in range(90):
-        try:
-            r = requests.get(url, timeout=5)
-            if r.status_code == 200:
-                log("Ollama reachable")
-                return
-        except Exception:
-            pass
+        up = sum(check_ollama_node(node) for node in _nodes)
+        if up:
+            log(f"Ollama reachable: {up}/{len(_nodes)} endpoints")
+            threading.Thread(target=ollama_health_loop, name="ollama-health", daemon=True).start()
+            return
         time.sleep(2)
     raise RuntimeError("Ollama not reachable after waiting")
 
@@ -278,51 +1622,473 @@ def decide_and_route(meta: dict, text: str) -> dict:
     }
 
 # ---------------------------
-# Main
+# Pre-gate
 # ---------------------------
-def main():
-    db_init()
-    log("Forwarder started")
-    log("Paperless:", PAPERLESS_BASE_URL)
-    log("Ollama:", OLLAMA_BASE_URL)
+# Each term counts once per document. Umlauts are matched as written, so both spellings are listed.
+PREGATE_TERMS = {
+    "rechnung": 1.5, "rechnungsnummer": 2.0, "rechnungsnr": 2.0, "rechnungsdatum": 2.0,
+    "invoice": 1.5, "invoice number": 2.0, "gutschrift": 1.0,
+    "ust": 1.0, "mwst": 1.0, "umsatzsteuer": 1.0, "ust-idnr": 1.0, "steuernummer": 0.5, "vat": 1.0,
+    "netto": 0.5, "brutto": 0.5, "zahlbar": 0.5, "zahlungsziel": 1.0, "fällig": 0.5, "faellig": 0.5,
+    "betrag": 0.5, "gesamtbetrag": 1.0, "kundennummer": 0.5, "lieferdatum": 0.5, "leistungszeitraum": 1.0,
+    "total": 0.5, "amount due": 1.0, "due date": 0.5,
+    "lohnabrechnung": -3.0, "gehaltsabrechnung": -3.0, "entgeltabrechnung": -3.0,
+    "verdienstabrechnung": -3.0, "payslip": -3.0, "kontoauszug": -2.0, "steuerbescheid": -2.0,
+    "bedienungsanleitung": -2.0, "gebrauchsanweisung": -2.0, "manual": -1.0, "lieferschein": -2.0,
+    "angebot": -1.5, "auftragsbestätigung": -1.5, "newsletter": -2.0,
+}
+TOTAL_REGEX = re.compile(r"\b(gesamt\w*|summe|endbetrag|rechnungsbetrag|zu zahlen|total)\b\W{0,30}\d[\d.,]*[.,]\d{2}\b", re.I)
+AMOUNT_REGEX = re.compile(r"(\d[\d.,]*[.,]\d{2}\s?(€|eur\b)|(€|eur)\s?\d[\d.,]*[.,]\d{2})", re.I)
+
+def load_pregate_terms() -> dict[str, float]:
+    terms = dict(PREGATE_TERMS)
+    if PREGATE_WEIGHTS:
+        terms.update({k.lower(): float(v) for k, v in json.loads(Path(PREGATE_WEIGHTS).read_text()).items()})
+    return terms
+
+_pregate_terms = load_pregate_terms()
+_pregate_regex = re.compile(r"\b(" + "|".join(sorted(map(re.escape, _pregate_terms), key=len, reverse=True)) + r")\b")
+
+def pregate_score(text: str) -> float:
+    t = (text or "").lower()
+    score = sum(_pregate_terms[m] for m in set(_pregate_regex.findall(t)))
+    if TOTAL_REGEX.search(t):
+        score += 2.0
+    if AMOUNT_REGEX.search(t):
+        score += 1.0
+    if extract_ibans(text.upper()):
+        score += 1.0
+    return score
+
+def pregate(doc_id: int, text: str) -> dict | None:
+    """
+    Returns a gate result when the rules are confident on their own, None for the
+    ambiguous middle that still goes to GATE_MODEL.
+    """
+    if not PREGATE:
+        return None
+    score = pregate_score(text)
+    if score < PREGATE_MIN:
+        verdict = {"is_invoice": False, "confidence": 0.0}
+    elif score >= PREGATE_MAX:
+        verdict = {"is_invoice": True, "confidence": 1.0}
+    else:
+        log(f"Doc {doc_id}: pre-gate score={score:.1f} -> gate model")
+        return None
+    log(f"Doc {doc_id}: pre-gate score={score:.1f} -> is_invoice={verdict['is_invoice']}")
+    return {**verdict, "notes": f"pre-gate score {score:.1f}"}
 
-    wait_for_paperless()
-    wait_for_ollama()
+# ---------------------------
+# Local gate model
+# ---------------------------
+GATE_LOCAL_DIM = 1 << 18  # hashed feature space
 
-    # create tags once
-    tags = {
-        "ai": get_or_create_tag_id(TAG_AI),
-        "invoice": get_or_create_tag_id(TAG_INVOICE),
-        "forwarded": get_or_create_tag_id(TAG_FORWARDED),
-        "not_forwarded": get_or_create_tag_id(TAG_NOT_FORWARDED),
-        "reason_iban": get_or_create_tag_id(TAG_REASON_IBAN),
-        "reason_keyword": get_or_create_tag_id(TAG_REASON_KEYWORD),
-        "topic_farm": get_or_create_tag_id(TAG_TOPIC_FARM),
-        "topic_it": get_or_create_tag_id(TAG_TOPIC_IT),
-        "it_deductible": get_or_create_tag_id(TAG_IT_DEDUCTIBLE),
+def gate_slice(text: str) -> str:
+    """
+    Head and tail of the text, as many chars as the gate prompt's window. window_text() would
+    put a line scorer over the whole OCR text on every prediction (~100 ms for 3000 lines).
+    """
+    half = GATE_TEXT_TOKENS * CHARS_PER_TOKEN // 2
+    return text if len(text) <= 2 * half else text[:half] + "\n" + text[-half:]
+
+def text_features(text: str, dim: int = GATE_LOCAL_DIM) -> list[int]:
+    """Hashed word unigrams + bigrams, binary presence, over gate_slice()."""
+    words = re.findall(r"\w+", gate_slice(text or "").lower())
+    grams = set(words)
+    grams.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    return sorted({zlib.crc32(g.encode()) & (dim - 1) for g in grams})
+
+def sigmoid(z: float) -> float:
+    return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+
+class GateModel:
+    """Logistic regression over text_features(); weights are float32, ~1 MB on disk."""
+
+    def __init__(self, dim: int = GATE_LOCAL_DIM, bias: float = 0.0, weights: array | None = None, info: dict | None = None):
+        self.dim = dim
+        self.bias = bias
+        self.w = weights if weights is not None else array("f", bytes(4 * dim))
+        self.info = info or {}
+
+    def score(self, feats: list[int]) -> float:
+        if not feats:
+            return sigmoid(self.bias)
+        w = self.w
+        return sigmoid(self.bias + sum(w[i] for i in feats) / math.sqrt(len(feats)))
+
+    def predict(self, text: str) -> float:
+        return self.score(text_features(text, self.dim))
+
+    def fit(self, samples: list[tuple[array, int]], epochs: int = GATE_TRAIN_EPOCHS, lr: float = 0.5) -> None:
+        """Plain SGD on log loss, classes weighted so a skewed archive does not tip the bias."""
+        pos = sum(y for _, y in samples)
+        neg = len(samples) - pos
+        cw = {1: len(samples) / (2 * max(pos, 1)), 0: len(samples) / (2 * max(neg, 1))}
+        rnd = random.Random(0)
+        w = self.w
+        for epoch in range(epochs):
+            rnd.shuffle(samples)
+            step = lr / (1 + epoch)
+            for feats, y in samples:
+                if not feats:
+                    continue
+                v = 1.0 / math.sqrt(len(feats))
+                g = (self.score(feats) - y) * cw[y] * step
+                self.bias -= g
+                gv = g * v
+                for i in feats:
+                    w[i] -= gv
+
+    def save(self, path: Path) -> None:
+        data = {"dim": self.dim, "bias": self.bias, "info": self.info,
+                "weights": base64.b64encode(self.w.tobytes()).decode()}
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data))
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "GateModel":
+        data = json.loads(path.read_text())
+        w = array("f")
+        w.frombytes(base64.b64decode(data["weights"]))
+        return cls(int(data["dim"]), float(data["bias"]), w, data.get("info"))
+
+_gate_model: GateModel | None = None
+_gate_model_loaded = False
+
+def gate_model() -> GateModel | None:
+    global _gate_model, _gate_model_loaded
+    if not _gate_model_loaded:
+        _gate_model_loaded = True
+        if GATE_LOCAL_PATH.exists():
+            _gate_model = GateModel.load(GATE_LOCAL_PATH)
+            log(f"Local gate model loaded: {GATE_LOCAL_PATH} {_gate_model.info}")
+        else:
+            log(f"WARN: GATE_MODE=local but {GATE_LOCAL_PATH} missing (run --train-gate) -> using GATE_MODEL")
+    return _gate_model
+
+def local_gate(doc_id: int, text: str) -> dict | None:
+    """Gate result from the local model when it is outside the confidence band, else None."""
+    if GATE_MODE != "local":
+        return None
+    model = gate_model()
+    if model is None:
+        return None
+    p = model.predict(text)
+    if GATE_LOCAL_LOW <= p < GATE_LOCAL_HIGH:
+        log(f"Doc {doc_id}: local gate p={p:.2f} -> gate model")
+        return None
+    log(f"Doc {doc_id}: local gate p={p:.2f} -> is_invoice={p >= GATE_LOCAL_HIGH}")
+    return {"is_invoice": p >= GATE_LOCAL_HIGH, "confidence": round(p, 3), "notes": f"local gate p={p:.2f}"}
+
+def cheap_gate(doc_id: int, text: str) -> dict | None:
+    """Rules, then the local model; None means the document needs GATE_MODEL."""
+    gate = pregate(doc_id, text)
+    if gate is None:
+        gate = local_gate(doc_id, text)
+    return gate
+
+def iter_labeled_docs(tags: dict):
+    """(text, is_invoice) for every document we have already classified, newest first."""
+    url = f"{PAPERLESS_BASE_URL}/api/documents/"
+    params = {"tags__id__all": tags["ai"], "ordering": "-id", "page_size": PAGE_SIZE, "fields": "id,content,tags"}
+    for page in paperless_iter_pages(url, params):
+        for d in page:
+            text = d.get("content") or ""
+            if text.strip():
+                yield text, int(tags["invoice"] in (d.get("tags") or []))
+
+def train_gate(tags: dict) -> None:
+    """
+    Fits the local gate on documents tagged TAG_AI, label = has TAG_INVOICE (manual tag
+    fixes in Paperless count). Holds out every 10th document to report accuracy and how
+    many documents the confidence band would decide without GATE_MODEL.
+    """
+    started = time.time()
+    train, holdout = [], []
+    for n, (text, y) in enumerate(iter_labeled_docs(tags)):
+        if n >= GATE_TRAIN_MAX:
+            break
+        (holdout if n % 10 == 9 else train).append((array("I", text_features(text)), y))
+    pos = sum(y for _, y in train)
+    log(f"Train gate: {len(train)} train / {len(holdout)} holdout docs, {pos} invoices")
+    if not pos or pos == len(train):
+        raise RuntimeError("Train gate: need both invoices and non-invoices tagged in Paperless")
+
+    model = GateModel()
+    model.fit(train)
+
+    tp = fp = fn = correct = decided = decided_ok = 0
+    for feats, y in holdout:
+        p = model.score(feats)
+        hit = int(p >= 0.5) == y
+        correct += hit
+        tp += p >= 0.5 and y == 1
+        fp += p >= 0.5 and y == 0
+        fn += p < 0.5 and y == 1
+        if not GATE_LOCAL_LOW <= p < GATE_LOCAL_HIGH:
+            decided += 1
+            decided_ok += int(p >= GATE_LOCAL_HIGH) == y
+    k = max(len(holdout), 1)
+    model.info = {
+        "trained_utc": int(time.time()),
+        "docs": len(train), "invoices": pos,
+        "accuracy": round(correct / k, 4),
+        "precision": round(tp / max(tp + fp, 1), 4),
+        "recall": round(tp / max(tp + fn, 1), 4),
+        "band_coverage": round(decided / k, 4),
+        "band_accuracy": round(decided_ok / max(decided, 1), 4),
     }
+    model.save(GATE_LOCAL_PATH)
+    log(f"Train gate: saved {GATE_LOCAL_PATH} in {time.time() - started:.0f}s {model.info}")
 
-    while True:
-        try:
-            docs = paperless_get_docs()
-            log(f"Polling... got {len(docs)} docs (latest)")
+# ---------------------------
+# Near-duplicates
+# ---------------------------
+def simhash(text: str) -> int | None:
+    """64-bit SimHash over 3-word shingles; None if the text is too short to say anything."""
+    words = re.findall(r"\w+", (text or "").lower())
+    if len(words) < DEDUP_MIN_WORDS:
+        return None
+    counts = [0] * 64
+    for shingle in {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            counts[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(64) if counts[bit] > 0)
+
+def norm_field(v) -> str:
+    return re.sub(r"[^0-9A-Z]", "", str(v or "").upper())
+
+INVOICE_NO_REGEX = re.compile(r"\b(?:rechnungs?|invoice)\s*-?\s*(?:nr|nummer|no|number)\b\.?\s*:?\s*([a-z0-9][\w/-]{2,})", re.I)
+AMOUNT_VALUE_REGEX = re.compile(r"\b\d[\d.,]*[.,]\d{2}\b")
+
+def text_keys(text: str) -> str:
+    """
+    Hash of the amounts, dates and invoice numbers in the OCR text. A rescan has the same ones;
+    next month's bill from the same vendor (same template, same IBAN, often the same amount) does not.
+    """
+    keys = {"a" + norm_field(m.group(0)) for m in AMOUNT_VALUE_REGEX.finditer(text)}
+    keys |= {"d" + norm_field(m.group(0)) for m in DATE_REGEX.finditer(text)}
+    keys |= {"n" + norm_field(m.group(1)) for m in INVOICE_NO_REGEX.finditer(text)}
+    return hashlib.blake2b("|".join(sorted(keys)).encode(), digest_size=8).hexdigest()
 
-            for d in docs:
-                doc_id = int(d["id"])
-                if already_done(doc_id):
-                    continue
+def _fingerprint_row(r) -> dict:
+    return {"doc_id": int(r[0]), "meta": json.loads(r[1]), "delivered": bool(r[2])}
 
-                text = paperless_get_text(doc_id)
-                if not text.strip():
-                    log(f"Doc {doc_id}: OCR text empty -> skip for now")
-                    continue
+def find_near_duplicate(doc_id: int, text: str) -> dict | None:
+    """
+    Earlier document with (almost) the same OCR text, checked before any LLM call.
+    If both texts contain IBANs they must share one, so two bills from the same template
+    but different accounts are not merged. Amounts, dates and invoice numbers must match
+    exactly: SimHash barely notices them in a long text.
+    """
+    if not DEDUP:
+        return None
+    h = simhash(text)
+    if h is None:
+        return None
+    with _db_lock:
+        best = min(((bin(h ^ other).count("1"), other_id) for other, other_id in _fingerprints
+                    if other_id != doc_id), default=None)
+        if best is None or best[0] > DEDUP_MAX_DISTANCE:
+            return None
+        r = db().execute("SELECT doc_id, meta, delivered, ibans, text_keys FROM doc_fingerprints WHERE doc_id=?",
+                         (best[1],)).fetchone()
+    ibans, other_ibans = extract_ibans(text), set(filter(None, r[3].split(",")))
+    if ibans and other_ibans and not ibans & other_ibans:
+        return None
+    if r[4] != text_keys(text):
+        log(f"Doc {doc_id}: similar to doc {r[0]} but amounts/dates/numbers differ -> not a duplicate")
+        return None
+    return _fingerprint_row(r)
+
+def find_invoice_duplicate(doc_id: int, meta: dict, text: str) -> dict | None:
+    """
+    Earlier document with the same extracted invoice number and total, plus the same date or IBAN.
+    The IBAN alone proves nothing (a vendor's bills all carry it), and the model may return a
+    customer number as invoice_number, so the amount always has to match.
+    """
+    if not DEDUP:
+        return None
+    invoice_number = norm_field(meta.get("invoice_number"))
+    amount = norm_field(meta.get("amount_total"))
+    if not invoice_number or not amount:
+        return None
+    date = norm_field(meta.get("date"))
+    ibans = extract_ibans(text)
+    with _db_lock:
+        rows = db().execute("SELECT doc_id, meta, delivered, ibans, amount FROM doc_fingerprints "
+                            "WHERE invoice_number=? AND amount=? AND doc_id!=?",
+                            (invoice_number, amount, doc_id)).fetchall()
+    for r in rows:
+        same_date = date and norm_field(json.loads(r[1]).get("date")) == date
+        if same_date or ibans & set(filter(None, r[3].split(","))):
+            return _fingerprint_row(r)
+    return None
+
+def mark_duplicate(doc_id: int, meta: dict, dup: dict) -> dict:
+    log(f"Doc {doc_id}: duplicate of doc {dup['doc_id']} (delivered={dup['delivered']})")
+    return {**meta, "duplicate_of": dup["doc_id"], "duplicate_delivered": dup["delivered"]}
+
+def record_fingerprint(doc_id: int, text: str, meta: dict, delivered: bool) -> None:
+    """Not committed here: commit_document() writes it together with the outbox rows and mark_done."""
+    global _db_uncommitted
+    if not DEDUP:
+        return
+    h = simhash(text)
+    stored = {k: v for k, v in meta.items() if not k.startswith("duplicate_")}
+    with _db_lock:
+        db().execute("INSERT OR REPLACE INTO doc_fingerprints(doc_id, simhash, ibans, invoice_number, amount, "
+                     "meta, delivered, created_utc, text_keys) VALUES(?,?,?,?,?,?,?,?,?)",
+                     (doc_id, None if h is None else f"{h:016x}", ",".join(sorted(extract_ibans(text))),
+                      norm_field(meta.get("invoice_number")), norm_field(meta.get("amount_total")),
+                      json.dumps(stored), int(delivered), int(time.time()), text_keys(text)))
+        _db_uncommitted += 1
+        if h is not None:
+            _fingerprints.append((h, doc_id))
 
-                log(f"Doc {doc_id}: content_len={len(text)}")
+# ---------------------------
+# Text windowing
+# ---------------------------
+CHARS_PER_TOKEN = 4  # rough for German/English OCR text
+WINDOW_HEAD_LINES = 8  # sender / title block, always kept
+WINDOW_LINE_CHARS = 300  # OCR sometimes glues a whole page into one line
+WINDOW_GAP = "[...]"
+DATE_REGEX = re.compile(r"\b\d{1,2}\.\s?\d{1,2}\.\s?(\d{4}|\d{2})\b|\b\d{4}-\d{2}-\d{2}\b")
+
+def line_score(line: str) -> float:
+    t = line.lower()
+    score = sum(abs(_pregate_terms[m]) for m in set(_pregate_regex.findall(t)))
+    if TOTAL_REGEX.search(t):
+        score += 5.0
+    if AMOUNT_REGEX.search(t):
+        score += 3.0
+    if IBAN_REGEX.search(line.upper()):
+        score += 4.0
+    if DATE_REGEX.search(t):
+        score += 2.0
+    if contains_any(t, KEYWORDS_FARMING) or contains_any(t, KEYWORDS_IT):
+        score += 2.0
+    return score
+
+def window_text(text: str, budget_tokens: int) -> str:
+    """
+    Picks the lines that carry invoice signal (totals, amounts, IBANs, dates, keywords)
+    plus the header and footer, within budget_tokens, in document order. Skipped runs
+    are marked "[...]". Texts that already fit are returned unchanged.
+    """
+    limit = budget_tokens * CHARS_PER_TOKEN
+    if not TEXT_WINDOW or len(text) <= limit:
+        return text[:limit]
+
+    lines, seen = [], set()
+    for raw in text.splitlines():
+        line = " ".join(raw.split())[:WINDOW_LINE_CHARS]
+        # repeated page headers/footers only once; lines without any word are OCR noise
+        if line and line not in seen and re.search(r"\w\w", line):
+            seen.add(line)
+            lines.append(line)
+
+    own = [line_score(l) for l in lines]
+    scores = []
+    for i, s in enumerate(own):
+        # labels and their values often sit on neighbouring lines in table layouts
+        near = max(own[i - 1] if i else 0.0, own[i + 1] if i + 1 < len(own) else 0.0)
+        s += 0.5 * near
+        if i < WINDOW_HEAD_LINES:
+            s += 100.0
+        elif i >= len(lines) - WINDOW_HEAD_LINES:
+            s += 1.0  # footer: bank details, tax ids
+        scores.append(s)
+
+    # every run of skipped lines costs a "[...]" line: nothing picked yet is one run
+    marker = len(WINDOW_GAP) + 1
+    picked, used = set(), marker
+    # signal lines first, then plain lines in document order while budget remains
+    for i in sorted(range(len(lines)), key=lambda i: (-scores[i], i)):
+        # picking i splits its skipped run into the parts left and right of it (0, 1 or 2 runs)
+        left = i > 0 and i - 1 not in picked
+        right = i + 1 < len(lines) and i + 1 not in picked
+        cost = len(lines[i]) + 1 + (left + right - 1) * marker
+        if used + cost > limit + 1:  # +1: no newline after the last line
+            continue
+        picked.add(i)
+        used += cost
+
+    out, last = [], -1
+    for i in sorted(picked):
+        if i != last + 1:
+            out.append(WINDOW_GAP)
+        out.append(lines[i])
+        last = i
+    if last != len(lines) - 1:
+        out.append(WINDOW_GAP)
+    return "\n".join(out)
 
-                # --- Gate (cheap)
-                gate_prompt = f"""
+# ---------------------------
+# Document processing
+# ---------------------------
+def fetch_document_text(doc_id: int) -> str | None:
+    try:
+        text = paperless_get_text(doc_id)
+    except Exception as e:
+        if not paperless_gone(e):
+            raise
+        log(f"Doc {doc_id}: not in Paperless, skipped")
+        forget_document(doc_id)
+        return None
+    if not text.strip():
+        record_failure(doc_id, "OCR text empty", "ocr")  # retried with backoff, not every poll
+        return None
+
+    log(f"Doc {doc_id}: content_len={len(text)}")
+    return text
+
+CONFIDENCE = {"type": "number", "minimum": 0.0, "maximum": 1.0}
+
+GATE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_invoice": {"type": "boolean"},
+        "confidence": CONFIDENCE,
+        "is_farming_related": {"type": "boolean"},
+        "farming_confidence": CONFIDENCE,
+        "is_it_related": {"type": "boolean"},
+        "it_confidence": CONFIDENCE,
+        "notes": {"type": "string"},
+    },
+    "required": ["is_invoice", "confidence", "is_farming_related", "farming_confidence",
+                 "is_it_related", "it_confidence", "notes"],
+}
+
+EXTRACT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_invoice": {"type": "boolean"},
+        "invoice_confidence": CONFIDENCE,
+        "is_farming_related": {"type": "boolean"},
+        "farming_confidence": CONFIDENCE,
+        "is_it_related": {"type": "boolean"},
+        "it_confidence": CONFIDENCE,
+        "it_deductible_for_tax": {"type": "boolean"},
+        "title": {"type": "string"},
+        "date": {"type": "string"},
+        "amount_total": {"type": "string"},
+        "currency": {"type": "string"},
+        "invoice_number": {"type": "string"},
+        "notes": {"type": "string"},
+    },
+    "required": ["is_invoice", "invoice_confidence", "is_farming_related", "farming_confidence",
+                 "is_it_related", "it_confidence", "it_deductible_for_tax", "title", "date",
+                 "amount_total", "currency", "invoice_number", "notes"],
+}
+
+# The instruction blocks go out as the system prompt, byte-identical for every document, so
+# Ollama can reuse their KV cache and only prefill the OCR text that follows.
+GATE_SYSTEM = """
 Return ONLY JSON:
-{{
+{
   "is_invoice": true|false,
   "confidence": 0.0,
 
@@ -333,21 +2099,12 @@ Return ONLY JSON:
   "it_confidence": 0.0,
 
   "notes": "short"
-}}
-OCR text:
-{text[:6000]}
+}
 """.strip()
 
-                gate = ollama_generate(GATE_MODEL, gate_prompt)
-                log(f"Doc {doc_id}: gate={gate}")
-
-                run_big = bool(gate.get("is_invoice")) and float(gate.get("confidence", 0.0) or 0.0) >= GATE_INVOICE_MIN
-
-                # --- Extract (expensive, only if gate says likely invoice)
-                if run_big:
-                    extract_prompt = f"""
+EXTRACT_SYSTEM = """
 Return ONLY JSON:
-{{
+{
   "is_invoice": true|false,
   "invoice_confidence": 0.0,
 
@@ -365,94 +2122,830 @@ Return ONLY JSON:
   "currency": "string or empty",
   "invoice_number": "string or empty",
   "notes": "short"
-}}
-OCR text:
-{text[:12000]}
+}
 """.strip()
-                    meta = ollama_generate(EXTRACT_MODEL, extract_prompt)
-                else:
-                    meta = {
-                        "is_invoice": False,
-                        "invoice_confidence": float(gate.get("confidence", 0.0) or 0.0),
-                        "is_farming_related": bool(gate.get("is_farming_related")),
-                        "farming_confidence": float(gate.get("farming_confidence", 0.0) or 0.0),
-                        "is_it_related": bool(gate.get("is_it_related")),
-                        "it_confidence": float(gate.get("it_confidence", 0.0) or 0.0),
-                        "it_deductible_for_tax": False,
-                        "notes": gate.get("notes", "")
-                    }
-
-                log(f"Doc {doc_id}: meta={meta}")
-
-                # Always add ai tag
-                add_tags_to_document(doc_id, [tags["ai"]])
-
-                decision = decide_and_route(meta, text)
-                log(f"Doc {doc_id}: decision={decision}")
-
-                # Tag invoice status
-                if decision["invoice"]:
-                    add_tags_to_document(doc_id, [tags["invoice"]])
-
-                # If forwarding, attach PDF
-                forwarded_any = False
-                if decision["forward_farm"] or decision["forward_it"]:
-                    pdf = download_pdf_bytes(doc_id)
-                    filename = f"paperless_{doc_id}.pdf"
-                    subject = f"Invoice (Paperless #{doc_id}): {meta.get('title','')}".strip()
-
-                    body = (
-                        "Invoice forwarded from Paperless.\n\n"
-                        f"doc_id: {doc_id}\n"
-                        f"title: {meta.get('title','')}\n"
-                        f"invoice_number: {meta.get('invoice_number','')}\n"
-                        f"total: {meta.get('amount_total','')} {meta.get('currency','')}\n"
-                        f"date: {meta.get('date','')}\n"
-                        f"invoice_confidence: {decision.get('invoice_conf')}\n"
-                        f"reasons: {', '.join(decision.get('reasons', []))}\n"
-                        f"ai_farm: {decision.get('ai_farm')} (conf={meta.get('farming_confidence','')})\n"
-                        f"ai_it: {decision.get('ai_it')} (conf={meta.get('it_confidence','')})\n"
-                        f"it_deductible_for_tax: {meta.get('it_deductible_for_tax','')}\n"
-                        f"iban_match: {decision.get('iban_match')}\n"
-                        f"keyword_match: {decision.get('keyword_match')}\n"
-                        f"notes: {meta.get('notes','')}\n"
-                    )
-
-                    if decision["forward_farm"]:
-                        send_email_with_pdf(FARM_FORWARD_TO, subject, body, filename, pdf)
-                        forwarded_any = True
-
-                    if decision["forward_it"]:
-                        send_email_with_pdf(IT_FORWARD_TO, subject, body, filename, pdf)
-                        forwarded_any = True
-
-                # Tags for forwarding outcome + reasons/topics
-                if forwarded_any:
-                    to_add = [tags["forwarded"]]
-                    if decision["iban_match"]:
-                        to_add.append(tags["reason_iban"])
-                    if decision["keyword_match"]:
-                        to_add.append(tags["reason_keyword"])
-                    if decision["ai_farm"]:
-                        to_add.append(tags["topic_farm"])
-                    if decision["ai_it"]:
-                        to_add.append(tags["topic_it"])
-                    if decision["it_deductible"]:
-                        to_add.append(tags["it_deductible"])
-                    add_tags_to_document(doc_id, to_add)
-                    log(f"Doc {doc_id}: forwarded (farm={decision['forward_farm']}, it={decision['forward_it']})")
-                else:
-                    if decision["invoice"]:
-                        add_tags_to_document(doc_id, [tags["not_forwarded"]])
-                    log(f"Doc {doc_id}: not forwarded")
 
-                # Mark done only after processing with non-empty OCR
-                mark_done(doc_id)
+def gate_prompt(text: str) -> str:
+    return "OCR text:\n" + window_text(text, GATE_TEXT_TOKENS)
+
+def extract_prompt(text: str) -> str:
+    return "OCR text:\n" + window_text(text, EXTRACT_TEXT_TOKENS)
+
+def wants_extract(gate: dict) -> bool:
+    return bool(gate.get("is_invoice")) and float(gate.get("confidence", 0.0) or 0.0) >= GATE_INVOICE_MIN
+
+def meta_from_gate(gate: dict) -> dict:
+    return {
+        "is_invoice": False,
+        "invoice_confidence": float(gate.get("confidence", 0.0) or 0.0),
+        "is_farming_related": bool(gate.get("is_farming_related")),
+        "farming_confidence": float(gate.get("farming_confidence", 0.0) or 0.0),
+        "is_it_related": bool(gate.get("is_it_related")),
+        "it_confidence": float(gate.get("it_confidence", 0.0) or 0.0),
+        "it_deductible_for_tax": False,
+        "notes": gate.get("notes", "")
+    }
+
+def resumed(doc_id: int, text: str, key: str):
+    """(found, value) of a checkpointed gate/meta for this document."""
+    cp = load_checkpoint(doc_id, text)
+    if cp is None or (key == "meta" and cp["meta"] is None):
+        return False, None
+    log(f"Doc {doc_id}: resuming after checkpoint '{cp['stage']}'")
+    return True, cp[key]
+
+def gate_document(doc_id: int, text: str) -> dict | None:
+    """
+    Rules and local model first, then the cheap LLM for what they cannot decide.
+    None in combined mode: the extract prompt carries the gate fields itself.
+    """
+    found, gate = resumed(doc_id, text, "gate")
+    if found:
+        return gate
+    gate = cheap_gate(doc_id, text)
+    if gate is None and LLM_SCHEDULE != "combined":
+        with timed("forwarder_stage_seconds", stage="gate"):
+            gate = ollama_generate(GATE_MODEL, gate_prompt(text), GATE_SCHEMA, GATE_NUM_PREDICT, GATE_SYSTEM)
+        log(f"Doc {doc_id}: gate={gate}")
+        save_checkpoint(doc_id, text, "gated", gate)
+    return gate
+
+def extract_document(doc_id: int, text: str, gate: dict | None) -> dict:
+    found, meta = resumed(doc_id, text, "meta")
+    if found:
+        return meta
+    # expensive, only if gate says likely invoice
+    if gate is None or wants_extract(gate):
+        with timed("forwarder_stage_seconds", stage="extract"):
+            meta = ollama_generate(EXTRACT_MODEL, extract_prompt(text), EXTRACT_SCHEMA, EXTRACT_NUM_PREDICT,
+                                   EXTRACT_SYSTEM)
+        dup = find_invoice_duplicate(doc_id, meta, text)
+        if dup:
+            meta = mark_duplicate(doc_id, meta, dup)
+        save_checkpoint(doc_id, text, "extracted", gate, meta)
+    else:
+        meta = meta_from_gate(gate)
+    log(f"Doc {doc_id}: meta={meta}")
+    return meta
+
+def classify_document(doc_id: int, text: str) -> dict:
+    # --- Re-scan of something we already classified: no LLM call at all
+    dup = find_near_duplicate(doc_id, text)
+    if dup:
+        meta = mark_duplicate(doc_id, dup["meta"], dup)
+        log(f"Doc {doc_id}: meta={meta}")
+        return meta
+    return extract_document(doc_id, text, gate_document(doc_id, text))
+
+def forward_mail(doc_id: int, meta: dict, decision: dict) -> tuple[str, str, str]:
+    """Returns (subject, body, filename) of the forwarding email."""
+    filename = f"paperless_{doc_id}.pdf"
+    subject = f"Invoice (Paperless #{doc_id}): {meta.get('title','')}".strip()
+
+    body = (
+        "Invoice forwarded from Paperless.\n\n"
+        f"doc_id: {doc_id}\n"
+        f"title: {meta.get('title','')}\n"
+        f"invoice_number: {meta.get('invoice_number','')}\n"
+        f"total: {meta.get('amount_total','')} {meta.get('currency','')}\n"
+        f"date: {meta.get('date','')}\n"
+        f"invoice_confidence: {decision.get('invoice_conf')}\n"
+        f"reasons: {', '.join(decision.get('reasons', []))}\n"
+        f"ai_farm: {decision.get('ai_farm')} (conf={meta.get('farming_confidence','')})\n"
+        f"ai_it: {decision.get('ai_it')} (conf={meta.get('it_confidence','')})\n"
+        f"it_deductible_for_tax: {meta.get('it_deductible_for_tax','')}\n"
+        f"iban_match: {decision.get('iban_match')}\n"
+        f"keyword_match: {decision.get('keyword_match')}\n"
+        f"notes: {meta.get('notes','')}\n"
+    )
+    return subject, body, filename
+
+def forward_recipients(decision: dict) -> list[str]:
+    to = []
+    if decision["forward_farm"]:
+        to.append(FARM_FORWARD_TO)
+    if decision["forward_it"]:
+        to.append(IT_FORWARD_TO)
+    return to
+
+def forwarded_tags(decision: dict, tags: dict) -> list[int]:
+    """Tags for forwarding outcome + reasons/topics."""
+    to_add = [tags["forwarded"]]
+    if decision["iban_match"]:
+        to_add.append(tags["reason_iban"])
+    if decision["keyword_match"]:
+        to_add.append(tags["reason_keyword"])
+    if decision["ai_farm"]:
+        to_add.append(tags["topic_farm"])
+    if decision["ai_it"]:
+        to_add.append(tags["topic_it"])
+    if decision["it_deductible"]:
+        to_add.append(tags["it_deductible"])
+    return to_add
+
+def document_tags(decision: dict, tags: dict, forwarded: bool, duplicate: bool = False) -> list[int]:
+    """The complete set of tags for a processed document, applied in one go."""
+    to_add = [tags["ai"]]  # Always add ai tag
+    if decision["invoice"]:
+        to_add.append(tags["invoice"])
+    if forwarded:
+        to_add += forwarded_tags(decision, tags)
+    elif duplicate:
+        to_add.append(tags["duplicate"])
+    elif decision["invoice"]:
+        to_add.append(tags["not_forwarded"])
+    return to_add
+
+def split_tags(decision: dict, tags: dict, recipients: list[str], duplicate: bool) -> tuple[list[int], list[int]]:
+    """(tags applied right away, tags the outbox applies once every email went out)"""
+    tag_ids = document_tags(decision, tags, forwarded=bool(recipients), duplicate=duplicate)
+    sent_tags = forwarded_tags(decision, tags) if recipients else []
+    return [t for t in tag_ids if t not in sent_tags], sent_tags
+
+def log_outcome(doc_id: int, meta: dict, decision: dict, recipients: list[str], duplicate: bool) -> None:
+    if duplicate:
+        log(f"Doc {doc_id}: not forwarded again (duplicate of doc {meta['duplicate_of']})")
+    elif recipients:
+        log(f"Doc {doc_id}: queued for forwarding (farm={decision['forward_farm']}, it={decision['forward_it']})")
+    else:
+        log(f"Doc {doc_id}: not forwarded")
+
+def commit_document(doc_id: int, text: str, meta: dict, decision: dict, recipients: list[str],
+                    sent_tags: list[int], duplicate: bool) -> None:
+    """
+    Records the fingerprint, queues the forwarding emails and marks the document done in the same
+    transaction: a fingerprint counted as delivered always comes with its outbox rows.
+    """
+    with _db_lock:
+        record_fingerprint(doc_id, text, meta, delivered=bool(recipients) or duplicate)
+        if recipients:
+            subject, body, filename = forward_mail(doc_id, meta, decision)
+            queue_email(doc_id, recipients, subject, body, filename, sent_tags)
+        # Mark done only after processing with non-empty OCR
+        mark_done(doc_id)
+
+def forward_document(doc_id: int, text: str, meta: dict, tags: dict) -> None:
+    decision = decide_and_route(meta, text)
+    log(f"Doc {doc_id}: decision={decision}")
+
+    recipients = forward_recipients(decision)
+    duplicate = bool(recipients) and bool(meta.get("duplicate_delivered"))
+    if duplicate:
+        recipients = []
+
+    tag_ids, sent_tags = split_tags(decision, tags, recipients, duplicate)
+    tag_document(doc_id, tag_ids)
+    log_outcome(doc_id, meta, decision, recipients, duplicate)
+    commit_document(doc_id, text, meta, decision, recipients, sent_tags, duplicate)
+
+def process_document(doc_id: int, tags: dict) -> None:
+    stage = "fetch"
+    try:
+        text = fetch_document_text(doc_id)
+        if text is None:
+            return
+        stage = "llm"
+        meta = classify_document(doc_id, text)
+        stage = "forward"
+        forward_document(doc_id, text, meta, tags)
+    except Exception as e:
+        raise StageError(stage, e) from e
+
+# ---------------------------
+# Pipeline
+# ---------------------------
+_STOP = object()
+
+# stage queues of the running pipeline, for the queue depth gauge
+_queues: dict[str, queue.Queue] = {}
+
+def _stage_worker(stage: str, fn, inq: queue.Queue, outq: queue.Queue | None, failed: set, lock: threading.Lock):
+    while True:
+        item = inq.get()
+        if item is _STOP:
+            inq.put(_STOP)  # let the other workers of this stage see it too
+            return
+        doc_id = item[0]
+        try:
+            out = fn(*item)
+        except Exception as e:
+            record_failure(doc_id, e, stage)
+            with lock:
+                failed.add(doc_id)
+            continue
+        if out is not None and outq is not None:
+            outq.put(out)
+
+def run_pipeline(doc_ids, tags: dict) -> set[int]:
+    """
+    Runs documents through three stages connected by bounded queues:
+      fetch (Paperless text) -> llm (gate/extract, own concurrency limit) -> forward (tags, PDF, SMTP)
+    so Paperless/SMTP round trips overlap with Ollama inference.
+    doc_ids may be a generator; it is consumed lazily. Returns the ids that raised.
+    """
+    def fetch(doc_id):
+        text = fetch_document_text(doc_id)
+        return None if text is None else (doc_id, text)
+
+    def llm(doc_id, text):
+        return (doc_id, text, classify_document(doc_id, text))
+
+    def forward(doc_id, text, meta):
+        forward_document(doc_id, text, meta, tags)
+
+    failed: set[int] = set()
+    lock = threading.Lock()
+    q_fetch = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    q_llm = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    q_forward = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    _queues.update(pipeline_fetch=q_fetch, pipeline_llm=q_llm, pipeline_forward=q_forward)
+
+    stages = [
+        ("fetch", fetch, q_fetch, q_llm, PIPELINE_FETCH_WORKERS),
+        ("llm", llm, q_llm, q_forward, PIPELINE_LLM_WORKERS),
+        ("forward", forward, q_forward, None, PIPELINE_FORWARD_WORKERS),
+    ]
+    threads = []
+    for name, fn, inq, outq, n in stages:
+        ts = [threading.Thread(target=_stage_worker, args=(name, fn, inq, outq, failed, lock),
+                               name=f"{name}-{i}", daemon=True) for i in range(max(1, n))]
+        for t in ts:
+            t.start()
+        threads.append((inq, ts))
+
+    for doc_id in doc_ids:
+        q_fetch.put((doc_id,))
+
+    # drain stage by stage: a stage is finished once all its workers saw the stop marker
+    for inq, ts in threads:
+        inq.put(_STOP)
+        for t in ts:
+            t.join()
+    _queues.clear()
+
+    return failed
+
+# ---------------------------
+# Batched LLM schedule
+# ---------------------------
+def run_batched(doc_ids, tags: dict) -> set[int]:
+    """
+    LLM_SCHEDULE=batched: per chunk of LLM_BATCH_SIZE documents, fetch all texts, run every
+    gate call, then every extract call, then forward. Ollama switches models twice per chunk
+    instead of up to twice per document. The gate and extract calls of a chunk run on as many
+    threads as the engine allows concurrent Ollama requests (PIPELINE_LLM_WORKERS,
+    ASYNC_LLM_CONCURRENCY, 1 for serial), so every OLLAMA_BASE_URL endpoint stays busy.
+    doc_ids may be a generator. Returns the ids that raised.
+    """
+    failed: set[int] = set()
+    llm_workers = {"async": ASYNC_LLM_CONCURRENCY, "pipeline": PIPELINE_LLM_WORKERS}.get(ENGINE, 1)
+
+    def attempt(stage: str, fn, doc_id: int, item):
+        try:
+            return True, fn(doc_id, item)
+        except Exception as e:
+            record_failure(doc_id, e, stage)
+            return False, None
+
+    def each(stage: str, items: dict, fn, workers: int = 1) -> dict:
+        if workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(min(workers, len(items)), thread_name_prefix=f"batched-{stage}") as pool:
+                results = list(pool.map(lambda kv: attempt(stage, fn, *kv), items.items()))
+        else:
+            results = [attempt(stage, fn, doc_id, item) for doc_id, item in items.items()]
+        out = {}
+        for doc_id, (ok, value) in zip(items, results):
+            if ok:
+                out[doc_id] = value
+            else:
+                failed.add(doc_id)
+        return out
+
+    def gate(doc_id, text):
+        dup = find_near_duplicate(doc_id, text)
+        if dup:
+            return mark_duplicate(doc_id, dup["meta"], dup), None
+        return None, gate_document(doc_id, text)
+
+    def extract(doc_id, pre):
+        meta, g = pre
+        if meta is not None:
+            log(f"Doc {doc_id}: meta={meta}")
+            return meta
+        return extract_document(doc_id, texts[doc_id], g)
+
+    it = iter(doc_ids)
+    while chunk := list(itertools.islice(it, max(1, LLM_BATCH_SIZE))):
+        texts = each("fetch", dict.fromkeys(chunk), lambda doc_id, _: fetch_document_text(doc_id))
+        texts = {doc_id: text for doc_id, text in texts.items() if text is not None}
+        gates = each("gate", texts, gate, llm_workers)
+        metas = each("extract", gates, extract, llm_workers)
+        each("forward", metas, lambda doc_id, meta: forward_document(doc_id, texts[doc_id], meta, tags))
+    return failed
+
+# ---------------------------
+# Async engine
+# ---------------------------
+async def _http_json(http, method: str, url: str, timeout: float, **kw) -> dict:
+    async with http.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kw) as r:
+        r.raise_for_status()
+        return await r.json()
+
+async def paperless_get_text_async(http, doc_id: int) -> str:
+    with timed("forwarder_stage_seconds", stage="paperless_detail"):
+        d = await _http_json(http, "GET", f"{PAPERLESS_BASE_URL}/api/documents/{doc_id}/", 60, headers=paperless_headers())
+    return d.get("content") or ""
+
+async def add_tags_to_documents_async(http, doc_ids: list[int], tag_ids: list[int]) -> None:
+    with timed("forwarder_stage_seconds", stage="tag"):
+        await _http_json(http, "POST", f"{PAPERLESS_BASE_URL}/api/documents/bulk_edit/", 60,
+                         headers=paperless_headers(), json=bulk_edit_payload(doc_ids, tag_ids))
+
+async def ollama_call_async(model: str, fn):
+    """ollama_call() for coroutines: await fn(base_url) on a balanced endpoint, with failover."""
+    tried = set()
+    while True:
+        node = await asyncio.to_thread(acquire_node, model, tried)
+        try:
+            out = await fn(node["url"])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            release_node(node, model, False)
+            tried.add(node["url"])
+            if len(tried) >= len(_nodes):
+                raise
+            log(f"Ollama {node['url']}: {e!r} -> next endpoint")
+            continue
+        except BaseException:
+            release_node(node, model, None)  # includes cancellation, so the slot is not leaked
+            raise
+        release_node(node, model, True)
+        return out
+
+async def ollama_stream_async(http, base: str, model: str, payload: dict) -> str:
+    stream = OllamaStream(model)
+    async with http.post(f"{base}/api/generate", json={**payload, "stream": True},
+                         timeout=aiohttp.ClientTimeout(total=900)) as r:
+        r.raise_for_status()
+        async for line in r.content:
+            if line.strip() and stream.feed(json.loads(line)):
+                r.close()  # hang up so Ollama stops generating
+                break
+    stream.log_stats()
+    return stream.text()
+
+async def ollama_generate_async(http, model: str, prompt: str, schema: dict | None = None,
+                                num_predict: int | None = None, system: str | None = None) -> dict:
+    payload = ollama_payload(model, prompt, schema, num_predict, system)
+    key = llm_cache_key(payload)
+    cached = await asyncio.to_thread(llm_cache_get, key)
+    if cached is not None:
+        log(f"LLM cache hit ({model})")
+        metric_inc("forwarder_llm_cache_hits_total", model=model)
+        return cached
+    if OLLAMA_STREAM:
+        out = await ollama_call_async(model, lambda base: ollama_stream_async(http, base, model, payload))
+    else:
+        data = await ollama_call_async(
+            model, lambda base: _http_json(http, "POST", f"{base}/api/generate", 900, json=payload))
+        eval_s = data.get("eval_duration", 0) / 1e9
+        log_llm_stats(model, (data.get("load_duration", 0) + data.get("prompt_eval_duration", 0)) / 1e9,
+                      data.get("eval_count", 0), data.get("eval_count", 0) / eval_s if eval_s else 0.0)
+        record_prompt_stats(model, data)
+        out = data.get("response") or ""
+    result = parse_model_json(out)
+    if schema:
+        result = validate_result(result, schema)
+    await asyncio.to_thread(llm_cache_put, key, model, result)
+    return result
+
+async def gate_document_async(http, doc_id: int, text: str, llm_slots: asyncio.Semaphore) -> dict | None:
+    """gate_document() with the LLM call on the event loop."""
+    found, gate = resumed(doc_id, text, "gate")
+    if found:
+        return gate
+    gate = cheap_gate(doc_id, text)
+    if gate is None and LLM_SCHEDULE != "combined":
+        async with llm_slots:
+            with timed("forwarder_stage_seconds", stage="gate"):
+                gate = await ollama_generate_async(http, GATE_MODEL, gate_prompt(text), GATE_SCHEMA,
+                                                   GATE_NUM_PREDICT, GATE_SYSTEM)
+        log(f"Doc {doc_id}: gate={gate}")
+        await asyncio.to_thread(save_checkpoint, doc_id, text, "gated", gate)
+    return gate
+
+async def extract_document_async(http, doc_id: int, text: str, gate: dict | None,
+                                 llm_slots: asyncio.Semaphore) -> dict:
+    """extract_document() with the LLM call on the event loop."""
+    found, meta = resumed(doc_id, text, "meta")
+    if found:
+        return meta
+    if gate is None or wants_extract(gate):
+        async with llm_slots:
+            with timed("forwarder_stage_seconds", stage="extract"):
+                meta = await ollama_generate_async(http, EXTRACT_MODEL, extract_prompt(text),
+                                                   EXTRACT_SCHEMA, EXTRACT_NUM_PREDICT, EXTRACT_SYSTEM)
+        dup = await asyncio.to_thread(find_invoice_duplicate, doc_id, meta, text)
+        if dup:
+            meta = mark_duplicate(doc_id, meta, dup)
+        await asyncio.to_thread(save_checkpoint, doc_id, text, "extracted", gate, meta)
+    else:
+        meta = meta_from_gate(gate)
+    log(f"Doc {doc_id}: meta={meta}")
+    return meta
+
+async def process_document_async(http, doc_id: int, tags: dict, llm_slots: asyncio.Semaphore) -> None:
+    """Same steps as process_document(), with non-blocking I/O."""
+    stage = "fetch"
+    try:
+        try:
+            text = await paperless_get_text_async(http, doc_id)
+        except Exception as e:
+            if not paperless_gone(e):
+                raise
+            log(f"Doc {doc_id}: not in Paperless, skipped")
+            await asyncio.to_thread(forget_document, doc_id)
+            return
+        if not text.strip():
+            await asyncio.to_thread(record_failure, doc_id, "OCR text empty", "ocr")
+            return
+        log(f"Doc {doc_id}: content_len={len(text)}")
+
+        stage = "llm"
+        dup = await asyncio.to_thread(find_near_duplicate, doc_id, text)
+        if dup:
+            meta = mark_duplicate(doc_id, dup["meta"], dup)
+            log(f"Doc {doc_id}: meta={meta}")
+        else:
+            gate = await gate_document_async(http, doc_id, text, llm_slots)
+            meta = await extract_document_async(http, doc_id, text, gate, llm_slots)
+
+        stage = "forward"
+        decision = decide_and_route(meta, text)
+        log(f"Doc {doc_id}: decision={decision}")
+
+        recipients = forward_recipients(decision)
+        duplicate = bool(recipients) and bool(meta.get("duplicate_delivered"))
+        if duplicate:
+            recipients = []
+
+        tag_ids, sent_tags = split_tags(decision, tags, recipients, duplicate)
+        if TAG_BATCH_SIZE > 0:
+            await asyncio.to_thread(queue_tags, doc_id, tag_ids)
+        else:
+            await add_tags_to_documents_async(http, [doc_id], tag_ids)
+        log_outcome(doc_id, meta, decision, recipients, duplicate)
+
+        # PDF download and SMTP happen in the outbox worker
+        await asyncio.to_thread(commit_document, doc_id, text, meta, decision, recipients, sent_tags, duplicate)
+    except Exception as e:
+        raise StageError(stage, e) from e
+
+async def _run_async(doc_ids, tags: dict) -> set[int]:
+    failed: set[int] = set()
+    it = iter(doc_ids)
+    take = asyncio.Lock()  # doc_ids may be a generator doing blocking I/O; advance it off-loop, one at a time
+    llm_slots = asyncio.Semaphore(ASYNC_LLM_CONCURRENCY)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_POOL)) as http:
+        async def worker():
+            while True:
+                async with take:
+                    doc_id = await asyncio.to_thread(next, it, None)
+                if doc_id is None:
+                    return
+                try:
+                    await process_document_async(http, doc_id, tags, llm_slots)
+                except Exception as e:
+                    await asyncio.to_thread(record_failure, doc_id, e)
+                    failed.add(doc_id)
+
+        await asyncio.gather(*(worker() for _ in range(max(1, ASYNC_CONCURRENCY))))
+
+    return failed
+
+def run_async_engine(doc_ids, tags: dict) -> set[int]:
+    """Processes doc_ids with up to ASYNC_CONCURRENCY documents in flight. Returns the ids that raised."""
+    return asyncio.run(_run_async(doc_ids, tags))
+
+def run_serial(doc_ids, tags: dict) -> set[int]:
+    failed = set()
+    for doc_id in doc_ids:
+        # one broken document must not hold up the ones behind it
+        try:
+            process_document(doc_id, tags)
+        except Exception as e:
+            failed.add(doc_id)
+            record_failure(doc_id, e)
+    return failed
+
+def run_batch(doc_ids, tags: dict) -> set[int]:
+    """Runs doc_ids on the configured engine. Returns the ids that raised."""
+    if LLM_SCHEDULE == "batched":
+        failed = run_batched(doc_ids, tags)
+    elif ENGINE == "async":
+        failed = run_async_engine(doc_ids, tags)
+    elif ENGINE == "pipeline":
+        failed = run_pipeline(doc_ids, tags)
+    else:
+        failed = run_serial(doc_ids, tags)
+    return failed
+
+# ---------------------------
+# Poll scheduling
+# ---------------------------
+def parse_quiet_hours(spec: str) -> tuple[int, int] | None:
+    """"HH[:MM]-HH[:MM]" -> (start, end) in minutes of the day; may wrap past midnight."""
+    if not spec.strip():
+        return None
+    m = re.fullmatch(r"\s*(\d{1,2})(?::(\d\d))?\s*-\s*(\d{1,2})(?::(\d\d))?\s*", spec)
+    if not m:
+        raise RuntimeError(f"Invalid QUIET_HOURS: {spec!r} (expected HH:MM-HH:MM)")
+    return int(m[1]) * 60 + int(m[2] or 0), int(m[3]) * 60 + int(m[4] or 0)
+
+QUIET = parse_quiet_hours(QUIET_HOURS)
+
+def in_quiet_hours() -> bool:
+    if QUIET is None:
+        return False
+    now = datetime.now()
+    minute = now.hour * 60 + now.minute
+    start, end = QUIET
+    return start <= minute < end if start <= end else minute >= start or minute < end
+
+def fresh_count(docs: list[dict], todo: list[int]) -> int:
+    """
+    Listed documents this sweep got through. Failed and dead-letter ones do not count, or a page
+    of documents failing during an outage (or one old dead letter) would keep the sweep at 0s.
+    """
+    attempted = set(todo)
+    return sum(1 for d in docs if int(d["id"]) in attempted and not retry_blocked(int(d["id"])))
+
+def next_poll_delay(delay: float, new: int, full: bool, base: float) -> float:
+    """
+    Seconds until the next sweep: none after a full page of new documents (a scan burst is
+    still arriving), base after a partial one, doubling up to POLL_MAX_SECONDS while idle.
+    Quiet hours raise the floor to QUIET_POLL_SECONDS but never hold back a burst.
+    """
+    if full:
+        return 0.0
+    delay = base if new else min(max(delay, base) * 2, max(POLL_MAX_SECONDS, base))
+    if in_quiet_hours():
+        delay = max(delay, QUIET_POLL_SECONDS)
+    return delay
+
+# ---------------------------
+# Webhook listener
+# ---------------------------
+WEBHOOK_MAX_BODY = 65536
+DOC_URL_REGEX = re.compile(r"/documents/(\d+)/")
+
+# ids pushed by webhooks, drained by the main loop
+_pushed: set[int] = set()
+_pushed_lock = threading.Lock()
+_work_wake = threading.Event()
+
+def push_document(doc_id: int) -> None:
+    with _pushed_lock:
+        _pushed.add(doc_id)
+        _work_wake.set()
+
+def take_pushed() -> list[int]:
+    with _pushed_lock:
+        ids = sorted(_pushed)
+        _pushed.clear()
+        _work_wake.clear()
+    return ids
+
+def webhook_doc_id(params: dict) -> int | None:
+    """document_id / doc_id / id, or the id inside a {doc_url} placeholder."""
+    for key in ("document_id", "doc_id", "id"):
+        v = params.get(key)
+        if isinstance(v, bool):  # {"id": true} is not document 1
+            continue
+        if (isinstance(v, int) or (isinstance(v, str) and v.strip().isdigit())) and int(v) > 0:
+            return int(v)
+    for v in params.values():
+        m = DOC_URL_REGEX.search(v) if isinstance(v, str) else None
+        if m:
+            return int(m.group(1))
+    return None
+
+class HttpHandler(BaseHTTPRequestHandler):
+    server_version = "paperless-forwarder"
+
+    def send(self, status: int, data: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def reply(self, status: int, body: dict) -> None:
+        self.send(status, json.dumps(body).encode(), "application/json")
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/metrics":
+            return self.reply(404, {"error": "not found"})
+        self.send(200, render_metrics().encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+    def authorized(self, query: dict) -> bool:
+        if not WEBHOOK_TOKEN:
+            return True
+        auth = self.headers.get("Authorization", "")
+        token = auth[7:] if auth.startswith("Bearer ") else query.get("token", "")
+        return hmac.compare_digest(token.encode(), WEBHOOK_TOKEN.encode())
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != WEBHOOK_PATH:
+            return self.reply(404, {"error": "not found"})
+        query = dict(parse_qsl(url.query))
+        if not self.authorized(query):
+            return self.reply(401, {"error": "unauthorized"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= WEBHOOK_MAX_BODY:
+            return self.reply(400, {"error": "invalid Content-Length"})
+        raw = self.rfile.read(length).decode("utf-8", "replace")
+        # Paperless sends JSON, or form fields when the action uses "send webhook params"
+        try:
+            body = json.loads(raw) if raw.lstrip().startswith("{") else dict(parse_qsl(raw))
+        except ValueError:
+            return self.reply(400, {"error": "invalid JSON"})
+        doc_id = webhook_doc_id({**query, **body})
+        if doc_id is None:
+            return self.reply(400, {"error": "no document id"})
+        push_document(doc_id)
+        log(f"Webhook: doc {doc_id} queued")
+        self.reply(202, {"queued": doc_id})
+
+    def log_message(self, fmt, *args):
+        pass
+
+def start_http_server() -> None:
+    if not HTTP_PORT:
+        return
+    server = ThreadingHTTPServer((HTTP_BIND, HTTP_PORT), HttpHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+    log(f"Listening on {HTTP_BIND}:{HTTP_PORT} (/metrics, webhook {WEBHOOK_PATH}, sweep every {RECONCILE_SECONDS}s)")
+    if not WEBHOOK_TOKEN and HTTP_BIND not in ("127.0.0.1", "::1", "localhost"):
+        log("WARNING: webhook open to the network without WEBHOOK_TOKEN; unknown ids are only skipped")
+
+# ---------------------------
+# Main
+# ---------------------------
+def advance_cursor(docs: list[dict]) -> None:
+    """
+    Moves the cursor past the listed documents (oldest first). Failed ones do not hold it
+    back: they are in doc_failures and come back through due_retries().
+    """
+    if docs:
+        save_cursor(docs[-1][POLL_CURSOR_FIELD], int(docs[-1]["id"]))
+
+def backfill(tags: dict) -> None:
+    """
+    Walks the whole archive page by page (oldest id first) and processes everything
+    not yet in processed_docs. Only one result page is held in memory at a time.
+    """
+    url = f"{PAPERLESS_BASE_URL}/api/documents/"
+    params = {"ordering": "id", "page_size": PAGE_SIZE, "fields": "id"}
+    seen = queued = 0
+    started = time.time()
+
+    def todo():
+        nonlocal seen, queued
+        for page in paperless_iter_pages(url, params):
+            ids = [int(d["id"]) for d in page]
+            done = already_done_many(ids)
+            metric_inc("forwarder_documents_total", len(done), result="skipped")
+            seen += len(ids)
+            rate = seen / max(time.time() - started, 1e-6)
+            log(f"Backfill: seen={seen} queued={queued} ({rate:.1f} docs/s listed)")
+            for doc_id in ids:
+                if doc_id not in done and not retry_blocked(doc_id):
+                    queued += 1
+                    yield doc_id
+
+    failed = run_batch(todo(), tags)
+    tag_dead_letters(tags)
+    flush_tags()
+    release_outbox()
+    send_outbox()
+    smtp_close()
+    if outbox_pending():
+        log(f"Backfill: {outbox_pending()} emails still queued, the regular run retries them")
+    db_commit()
+    elapsed = time.time() - started
+    log(f"Backfill finished ({ENGINE}): seen={seen} queued={queued} failed={len(failed)} in {elapsed:.0f}s")
+
+def main():
+    ap = argparse.ArgumentParser(description="Classify Paperless documents and forward invoices by email")
+    ap.add_argument("--backfill", action="store_true",
+                    help="process every document in the archive that is not done yet, then exit")
+    ap.add_argument("--train-gate", action="store_true",
+                    help=f"fit the local gate model on already tagged documents, save it to {GATE_LOCAL_PATH}, then exit")
+    ap.add_argument("--retry-failed", action="store_true",
+                    help="give documents parked as dead letters a fresh set of attempts, then continue")
+    args = ap.parse_args()
+
+    db_init()
+    if args.retry_failed:
+        log(f"Requeued {requeue_dead_letters()} dead-letter docs")
+    log("Forwarder started")
+    log("Paperless:", PAPERLESS_BASE_URL)
+    log("Ollama:", ", ".join(OLLAMA_URLS))
+
+    wait_for_paperless()
+    if not args.train_gate:
+        wait_for_ollama()
+
+    # create tags once
+    tags = {
+        "ai": get_or_create_tag_id(TAG_AI),
+        "invoice": get_or_create_tag_id(TAG_INVOICE),
+        "forwarded": get_or_create_tag_id(TAG_FORWARDED),
+        "not_forwarded": get_or_create_tag_id(TAG_NOT_FORWARDED),
+        "reason_iban": get_or_create_tag_id(TAG_REASON_IBAN),
+        "reason_keyword": get_or_create_tag_id(TAG_REASON_KEYWORD),
+        "topic_farm": get_or_create_tag_id(TAG_TOPIC_FARM),
+        "topic_it": get_or_create_tag_id(TAG_TOPIC_IT),
+        "it_deductible": get_or_create_tag_id(TAG_IT_DEDUCTIBLE),
+        "duplicate": get_or_create_tag_id(TAG_DUPLICATE),
+        "failed": get_or_create_tag_id(TAG_FAILED),
+    }
+
+    if args.train_gate:
+        train_gate(tags)
+        return
+
+    start_outbox_worker()
+    start_http_server()
+
+    if args.backfill:
+        backfill(tags)
+        return
+
+    # with the webhook listener the poll is only a reconciliation sweep for missed events
+    sweep_seconds = RECONCILE_SECONDS if HTTP_PORT else POLL_SECONDS
+    delay = sweep_seconds
+    next_sweep = 0.0
+    while True:
+        try:
+            pushed = take_pushed()
+            sweep = time.time() >= next_sweep
+            docs = []
+            if sweep:
+                next_sweep = time.time() + delay
+                if POLL_MODE == "cursor":
+                    cursor = get_cursor()
+                    log(f"Polling... {POLL_CURSOR_FIELD} cursor={cursor}")
+                    docs = paperless_get_docs_since(cursor)
+                else:
+                    docs = paperless_get_docs()
+                    log(f"Polling... got {len(docs)} docs (latest)")
+
+            started = time.time()
+            docs = list(docs)  # cursor mode lists only id + timestamp, so this stays small
+            ids = [int(d["id"]) for d in docs]
+            listed = set(ids)
+            ids += [doc_id for doc_id in pushed if doc_id not in listed]
+            listed.update(pushed)
+            done = already_done_many(ids)
+            metric_inc("forwarder_documents_total", len(done), result="skipped")
+            todo = [doc_id for doc_id in ids if doc_id not in done and not retry_blocked(doc_id)]
+            todo += [doc_id for doc_id in due_retries() if doc_id not in listed]
+            n = len(todo)
+            failed = run_batch(todo, tags) if todo else set()
+            if sweep:
+                if POLL_MODE == "cursor":
+                    advance_cursor(docs)
+                new = fresh_count(docs, todo)
+                full = new >= (PAGE_SIZE if POLL_MODE == "cursor" else MAX_DOCS)
+                previous, delay = delay, next_poll_delay(delay, new, full, sweep_seconds)
+                next_sweep = time.time() + delay
+                metric_set("forwarder_poll_interval_seconds", delay)
+                if delay != previous:
+                    log(f"Next poll in {delay:.0f}s ({new} new docs)")
+            tag_dead_letters(tags)
+            if failed:
+                log(f"Poll: {len(failed)} of {n} docs failed, retried later")
+
+            flush_tags()
+            if n:
+                elapsed = time.time() - started
+                log(f"Poll done ({ENGINE}): {n} docs in {elapsed:.1f}s ({n / max(elapsed, 1e-6):.2f} docs/s)")
 
         except Exception as e:
             log("ERROR:", repr(e))
 
-        time.sleep(POLL_SECONDS)
+        db_commit()
+        release_outbox()
+        smtp_keepalive()
+        # a webhook wakes the loop early; retries and the sweep are checked at least every POLL_SECONDS
+        _work_wake.wait(max(0.0, min(POLL_SECONDS, next_sweep - time.time())))
 
 if __name__ == "__main__":
     main()
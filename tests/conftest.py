@@ -0,0 +1,8 @@
+import os
+import sys
+
+# app.py reads its configuration at import time
+for k in ("PAPERLESS_TOKEN", "SMTP_HOST", "SMTP_USER", "SMTP_PASS", "FARM_FORWARD_TO", "IT_FORWARD_TO"):
+    os.environ.setdefault(k, "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
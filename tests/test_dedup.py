@@ -0,0 +1,29 @@
+import sqlite3
+
+import app
+
+TERMS = " ".join(f"Bedingung{i % 97} gilt fuer Lieferung und Zahlung Abschnitt" for i in range(130))
+
+
+def bill(date: str, number: str) -> str:
+    return f"Stadtwerke Rechnung Nr {number} Datum {date} Betrag 84,00 EUR IBAN DE89370400440532013000\n" + TERMS
+
+
+def test_rescan_has_same_text_keys():
+    assert app.text_keys(bill("01.03.2024", "SW2024031")) == app.text_keys(bill("01.03.2024", "SW2024031"))
+
+
+def test_next_months_bill_differs_despite_same_amount_and_iban():
+    march, april = bill("01.03.2024", "SW2024031"), bill("01.04.2024", "SW2024047")
+    assert bin(app.simhash(march) ^ app.simhash(april)).count("1") <= app.DEDUP_MAX_DISTANCE
+    assert app.text_keys(march) != app.text_keys(april)
+
+
+def test_same_number_and_iban_with_different_amount_is_not_a_duplicate(monkeypatch):
+    monkeypatch.setattr(app, "_db", sqlite3.connect(":memory:", check_same_thread=False))
+    app.db_init()
+    march = {"invoice_number": "K-1001", "amount_total": "84,00", "date": "2024-03-01"}
+    app.record_fingerprint(1, bill("01.03.2024", "K-1001"), march, True)
+    april = {**march, "amount_total": "91,50", "date": "2024-04-01"}
+    assert app.find_invoice_duplicate(2, april, bill("01.04.2024", "K-1001")) is None
+    assert app.find_invoice_duplicate(2, march, bill("01.03.2024", "K-1001"))["doc_id"] == 1
@@ -0,0 +1,20 @@
+import requests
+
+import app
+
+
+class Response:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+
+def test_outages_are_not_document_errors():
+    assert app.is_outage(app.BackendUnavailable("No healthy Ollama endpoint"))
+    assert app.is_outage(requests.ConnectionError("refused"))
+    assert app.is_outage(requests.HTTPError("502", response=Response(502)))
+
+
+def test_document_errors_count():
+    assert not app.is_outage("OCR text empty")
+    assert not app.is_outage(ValueError("model returned no JSON"))
+    assert not app.is_outage(requests.HTTPError("400", response=Response(400)))
@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+import requests
+
+import app
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    monkeypatch.setattr(app, "_db", sqlite3.connect(":memory:", check_same_thread=False))
+    monkeypatch.setattr(app, "SMTP_DIGEST", False)
+    monkeypatch.setattr(app, "OUTBOX_BACKOFF", 0)
+    monkeypatch.setattr(app, "download_pdf_bytes", lambda doc_id: b"%PDF")
+    app.db_init()
+    sent, tagged = [], []
+    monkeypatch.setattr(app, "send_email_with_pdf", lambda to, *a: sent.append(to))
+    monkeypatch.setattr(app, "add_tags_to_documents", lambda doc_ids, tag_ids: tagged.extend(doc_ids))
+    app.queue_email(1, ["farm@example.org", "it@example.org"], "Rechnung", "body", "1.pdf", [7, 8])
+    app.queue_email(2, ["farm@example.org"], "Rechnung", "body", "2.pdf", [7])
+    app.db_commit()
+    return sent, tagged
+
+
+def test_tags_survive_a_paperless_outage_after_sending(monkeypatch, outbox):
+    sent, tagged = outbox
+
+    def down(doc_ids, tag_ids):
+        raise requests.ConnectionError("refused")
+    monkeypatch.setattr(app, "add_tags_to_documents", down)
+    assert app.send_outbox() == 3
+    assert app.outbox_pending() == 3
+
+    monkeypatch.setattr(app, "add_tags_to_documents", lambda doc_ids, tag_ids: tagged.extend(doc_ids))
+    assert app.send_outbox() == 0
+    assert len(sent) == 3
+    assert sorted(tagged) == [1, 2]
+    assert app.outbox_pending() == 0
+
+
+def test_email_for_deleted_document_is_dropped(monkeypatch, outbox):
+    sent, tagged = outbox
+
+    def gone(doc_id):
+        if doc_id == 1:
+            raise requests.HTTPError("404", response=type("R", (), {"status_code": 404})())
+        return b"%PDF"
+    monkeypatch.setattr(app, "download_pdf_bytes", gone)
+    assert app.send_outbox() == 1
+    assert tagged == [2]
+    assert app.outbox_pending() == 0
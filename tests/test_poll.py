@@ -0,0 +1,37 @@
+import time
+
+import app
+
+BASE = 30
+PAGE = list(range(1, app.MAX_DOCS + 1))
+
+
+def sweep(monkeypatch, done: set, failures: dict, failed_now: dict | None = None, delay: float = BASE):
+    """
+    One latest-mode sweep over the MAX_DOCS newest docs: `failures` exist before it,
+    `failed_now` are recorded while running it. Returns (new, next delay).
+    """
+    monkeypatch.setattr(app, "_failures", dict(failures))
+    monkeypatch.setattr(app, "QUIET", None)
+    docs = [{"id": i} for i in PAGE]
+    todo = [i for i in PAGE if i not in done and not app.retry_blocked(i)]
+    app._failures.update(failed_now or {})
+    new = app.fresh_count(docs, todo)
+    return new, app.next_poll_delay(delay, new, new >= app.MAX_DOCS, BASE)
+
+
+def test_full_page_of_new_docs_polls_again_at_once(monkeypatch):
+    assert sweep(monkeypatch, set(), {}) == (app.MAX_DOCS, 0.0)
+
+
+def test_full_page_failing_during_outage_backs_off(monkeypatch):
+    later = int(time.time()) + 60
+    new, delay = sweep(monkeypatch, set(), {}, failed_now={i: (later, False) for i in PAGE})
+    assert new == 0
+    assert delay == 2 * BASE
+
+
+def test_dead_letter_does_not_stop_idle_backoff(monkeypatch):
+    new, delay = sweep(monkeypatch, set(PAGE[1:]), {PAGE[0]: (0, True)}, delay=2 * BASE)
+    assert new == 0
+    assert delay == min(4 * BASE, max(app.POLL_MAX_SECONDS, BASE))
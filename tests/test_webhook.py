@@ -0,0 +1,9 @@
+import app
+
+
+def test_webhook_doc_id():
+    assert app.webhook_doc_id({"document_id": 42}) == 42
+    assert app.webhook_doc_id({"doc_id": " 7 "}) == 7
+    assert app.webhook_doc_id({"id": True}) is None
+    assert app.webhook_doc_id({"id": -3}) is None
+    assert app.webhook_doc_id({"id": 0}) is None
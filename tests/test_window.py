@@ -0,0 +1,20 @@
+import random
+
+import app
+
+WORDS = ["Rechnung", "Betrag", "84,00 EUR", "01.03.2024", "Lieferung", "Artikel", "Menge",
+         "IBAN DE89370400440532013000", "Summe", "Text", "foo", "bar"]
+
+
+def ocr_text(lines: int) -> str:
+    rnd = random.Random(lines)
+    return "\n".join(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12))) + f" {i}" for i in range(lines))
+
+
+def test_window_stays_within_budget_including_gap_markers():
+    for lines in (200, 3000):
+        text = ocr_text(lines)
+        for budget in (app.GATE_TEXT_TOKENS, app.EXTRACT_TEXT_TOKENS):
+            out = app.window_text(text, budget)
+            assert app.WINDOW_GAP in out
+            assert len(out) <= budget * app.CHARS_PER_TOKEN